@@ -0,0 +1,517 @@
+"""Test case for torchsharp.data ."""
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+import init_path
+import torchsharp.data as data
+
+try:
+    import cv2
+    _HAS_CV2 = True
+except ImportError:
+    _HAS_CV2 = False
+
+try:
+    import skvideo
+    import skvideo.io
+    _HAS_SKVIDEO = bool(skvideo._HAS_FFMPEG)
+except ImportError:
+    _HAS_SKVIDEO = False
+
+
+class _DummyImageDataset(object):
+    """Dataset of (path, label) like ImageFolder."""
+
+    def __init__(self, num_samples, num_classes=3):
+        """Init dataset."""
+        self.imgs = [("{}.jpg".format(idx), idx % num_classes)
+                     for idx in range(num_samples)]
+        self.classes = list(range(num_classes))
+
+    def __getitem__(self, index):
+        """Get sample."""
+        return self.imgs[index]
+
+    def __len__(self):
+        """Get size of dataset."""
+        return len(self.imgs)
+
+
+class Tester(unittest.TestCase):
+    """Tester."""
+
+    def setUp(self):
+        """Create temporary folder."""
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary folder."""
+        shutil.rmtree(self.tmpdir)
+
+    @unittest.skipUnless(_HAS_SKVIDEO, "scikit-video with ffmpeg required")
+    def test_video_streaming(self):
+        """Streaming decoding should match decoding whole video."""
+        filepath = os.path.join(self.tmpdir, "video.avi")
+        frames = np.random.randint(0, 255, (40, 16, 16, 3), dtype=np.uint8)
+        skvideo.io.vwrite(
+            filepath, frames, outputdict={"-vcodec": "rawvideo"})
+        expected = data.datasets.VideoDataset(filepath)
+        streamed = data.datasets.VideoDataset(
+            filepath, streaming=True, chunk_size=8)
+        for index in list(range(len(expected))) + [33, 2, 17, -1]:
+            np.testing.assert_array_equal(streamed[index][1],
+                                          expected[index][1])
+        streamed.close()
+
+    @unittest.skipUnless(_HAS_SKVIDEO, "scikit-video with ffmpeg required")
+    def test_video_cache(self):
+        """Frame store should be built once and memory-mapped later."""
+        filepath = os.path.join(self.tmpdir, "video.avi")
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        frames = np.random.randint(0, 255, (20, 16, 16, 3), dtype=np.uint8)
+        skvideo.io.vwrite(
+            filepath, frames, outputdict={"-vcodec": "rawvideo"})
+        expected = data.datasets.VideoDataset(filepath)
+        cached = data.datasets.VideoDataset(filepath, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        reloaded = data.datasets.VideoDataset(filepath, cache_dir=cache_dir)
+        self.assertIsInstance(reloaded.frames, np.memmap)
+        for index in range(len(expected)):
+            np.testing.assert_array_equal(reloaded[index][1],
+                                          expected[index][1])
+        self.assertEqual(len(cached), len(reloaded))
+
+    @unittest.skipUnless(_HAS_SKVIDEO, "scikit-video with ffmpeg required")
+    def test_video_clips(self):
+        """Clips should be located across videos by global index."""
+        filepaths = []
+        for idx, num_frames in enumerate([20, 9, 13]):
+            filepath = os.path.join(self.tmpdir, "{}.avi".format(idx))
+            frames = np.random.randint(
+                0, 255, (num_frames, 16, 16, 3), dtype=np.uint8)
+            skvideo.io.vwrite(
+                filepath, frames, outputdict={"-vcodec": "rawvideo"})
+            filepaths.append(filepath)
+        index_path = os.path.join(self.tmpdir, "index.npz")
+        dataset = data.datasets.VideoClipDataset(
+            filepaths, clip_len=8, stride=4, index_path=index_path)
+        self.assertEqual(len(dataset), 4 + 1 + 2)
+        self.assertEqual(dataset.locate(5), (2, 0))
+        self.assertEqual(dataset.locate(6), (2, 4))
+        clip, label = dataset[6]
+        self.assertEqual(clip.shape, (8, 16, 16, 3))
+        self.assertEqual(label, 2)
+        cached = data.datasets.VideoClipDataset(
+            filepaths, clip_len=8, stride=4, index_path=index_path)
+        np.testing.assert_array_equal(cached.offsets, dataset.offsets)
+        # modified video should invalidate cached index
+        skvideo.io.vwrite(filepaths[1], np.zeros((13, 16, 16, 3), np.uint8),
+                          outputdict={"-vcodec": "rawvideo"})
+        modified = data.datasets.VideoClipDataset(
+            filepaths, clip_len=8, stride=4, index_path=index_path)
+        self.assertEqual(len(modified), 4 + 2 + 2)
+
+    def test_split_dataset(self):
+        """Subsets should partition dataset and keep class ratio."""
+        labels = np.repeat(np.arange(4), [10, 20, 30, 40])
+        split = data.split_dataset(
+            range(100), trainval_rate=0.75, labels=labels, seed=0)
+        subsets = np.concatenate(
+            [split["train"], split["val"], split["test"]])
+        np.testing.assert_array_equal(np.sort(subsets), np.arange(100))
+        np.testing.assert_array_equal(
+            np.bincount(labels[split["test"]]), [3, 5, 8, 10])
+
+    def test_kfold_split(self):
+        """Validation folds should cover dataset once per repeat."""
+        folds = data.kfold_split(range(23), num_folds=4, num_repeats=2)
+        self.assertEqual(len(folds), 8)
+        for repeat in range(2):
+            val = np.concatenate(
+                [fold["val"] for fold in folds[repeat * 4:repeat * 4 + 4]])
+            np.testing.assert_array_equal(np.sort(val), np.arange(23))
+
+    def test_hash_split(self):
+        """Hash split should be stable when dataset grows."""
+        keys = ["{}.jpg".format(idx) for idx in range(200)]
+        split = data.hash_split(keys[:100])
+        grown = data.hash_split(keys)
+        for subset in ("train", "val", "test"):
+            np.testing.assert_array_equal(
+                split[subset], grown[subset][grown[subset] < 100])
+
+    def test_dataset_split_io(self):
+        """Saved split should be loaded as the same index arrays."""
+        filepath = os.path.join(self.tmpdir, "split.pt")
+        split = data.split_dataset(
+            range(50), save_split=True, save_path=filepath)
+        loaded = data.load_dataset_split(filepath)
+        self.assertEqual(loaded["all"].dtype, np.int32)
+        for subset in split:
+            np.testing.assert_array_equal(loaded[subset], split[subset])
+
+    def test_balanced_weights(self):
+        """Weights should balance classes and skip empty classes."""
+        images = [("a.jpg", 0), ("b.jpg", 0), ("c.jpg", 2)]
+        weights = data.get_balanced_weights(images, num_classes=4)
+        self.assertTrue(torch.is_tensor(weights))
+        self.assertEqual(weights.tolist(), [1.5, 1.5, 3.0])
+        np.testing.assert_array_equal(
+            data.get_balanced_weights(np.array([0, 0, 2]), 4), weights)
+
+    def test_balanced_sampler(self):
+        """Infinite sampler should keep drawing after one epoch."""
+        images = [("a.jpg", 0), ("b.jpg", 0), ("c.jpg", 1)]
+        sampler = data.samplers.get_balanced_sampler(images, 2)
+        self.assertEqual(len(list(sampler)), 3)
+        sampler = data.samplers.get_balanced_sampler(
+            images, 2, infinite=True)
+        self.assertEqual(len(list(itertools.islice(sampler, 10))), 10)
+
+    def test_slice_dataset(self):
+        """Slice of slice should map to the original dataset directly."""
+        dataset = _DummyImageDataset(20)
+        sliced = data.datasets.SliceDataset(dataset, [1, 5, 7, 9, 11])
+        nested = data.datasets.SliceDataset(sliced, np.array([0, 3]))
+        self.assertIs(nested.dataset, dataset)
+        np.testing.assert_array_equal(nested.excerpt, [1, 9])
+        np.testing.assert_array_equal(nested.targets, [1, 0])
+        self.assertEqual(nested.imgs, [("1.jpg", 1), ("9.jpg", 0)])
+        self.assertEqual(nested[1], ("9.jpg", 0))
+
+    def test_prefetch_iterator(self):
+        """Prefetch iterator should continue over epoch boundaries."""
+        dataset = TensorDataset(torch.arange(10))
+        iterator = data.iterators.PrefetchIterator(
+            DataLoader(dataset, batch_size=4), queue_depth=2, device="cpu")
+        batches = [batch[0].tolist() for batch in
+                   itertools.islice(iterator, 4)]
+        iterator.close()
+        self.assertEqual(batches,
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9], [0, 1, 2, 3]])
+
+    def test_inf_iterator_skip(self):
+        """Restored iterator should not load skipped batches."""
+        loaded = []
+
+        class _Dataset(TensorDataset):
+
+            def __getitem__(self, index):
+                loaded.append(index)
+                return super(_Dataset, self).__getitem__(index)
+
+        loader = DataLoader(_Dataset(torch.arange(10)), batch_size=4,
+                            shuffle=True)
+        iterator = data.iterators.InfIterator(loader)
+        next(iterator)
+        state = iterator.state_dict()
+        expected = next(iterator)[0].tolist()
+        del loaded[:]
+        iterator = data.iterators.InfIterator(loader)
+        iterator.load_state_dict(state)
+        self.assertEqual(next(iterator)[0].tolist(), expected)
+        self.assertEqual(loaded, expected)
+        self.assertEqual(len(next(iterator)[0]), 2)
+
+    def test_empty_loader(self):
+        """Infinite iterators should raise on loader without batches."""
+        loader = DataLoader(TensorDataset(torch.arange(3)), batch_size=4,
+                            drop_last=True)
+        with self.assertRaises(ValueError):
+            next(data.iterators.InfIterator(loader))
+        iterator = data.iterators.PrefetchIterator(loader)
+        with self.assertRaises(ValueError):
+            next(iterator)
+
+    def test_cached_loader(self):
+        """Cached loader should decode image only once."""
+        filepath = os.path.join(self.tmpdir, "image.npy")
+        np.save(filepath, np.random.randint(0, 255, (8, 8, 3), np.uint8))
+        loader = data.loaders.CachedLoader(
+            np.load, cache_dir=os.path.join(self.tmpdir, "cache"))
+        np.testing.assert_array_equal(loader(filepath), np.load(filepath))
+        np.testing.assert_array_equal(loader(filepath), np.load(filepath))
+        self.assertEqual((loader.hits, loader.misses), (1, 1))
+
+    def test_cached_loader_capacity(self):
+        """Loaders sharing cache should keep it within capacity."""
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        loaders = [
+            data.loaders.CachedLoader(
+                np.load, cache_dir=cache_dir, capacity=2000)
+            for _ in range(4)
+        ]
+        for idx in range(20):
+            filepath = os.path.join(self.tmpdir, "{}.npy".format(idx))
+            np.save(filepath, np.zeros((8, 8, 3), np.uint8))
+            loaders[idx % 4](filepath)
+        self.assertLessEqual(loaders[0]._scan()[0], 2000)
+
+    def test_cached_loader_without_fcntl(self):
+        """Cached loader should work without locking on non-POSIX."""
+        filepath = os.path.join(self.tmpdir, "image.npy")
+        np.save(filepath, np.zeros((8, 8, 3), np.uint8))
+        fcntl = data.loaders.fcntl
+        data.loaders.fcntl = None
+        try:
+            loader = data.loaders.CachedLoader(
+                np.load, cache_dir=os.path.join(self.tmpdir, "cache"))
+            loader(filepath)
+            loader(filepath)
+        finally:
+            data.loaders.fcntl = fcntl
+        self.assertEqual((loader.hits, loader.misses), (1, 1))
+
+    @unittest.skipUnless(_HAS_CV2, "opencv required")
+    def test_reduced_loader(self):
+        """Large JPEG should be decoded at reduced scale."""
+        filepath = os.path.join(self.tmpdir, "image.jpg")
+        cv2.imwrite(filepath, np.zeros((1200, 1000, 3), np.uint8))
+        loader = data.loaders.ReducedLoader((256, 256))
+        self.assertEqual(loader.get_scale(filepath), 2)
+        self.assertEqual(loader(filepath).shape, (256, 256, 3))
+        self.assertEqual(loader.stats()["samples"], 1)
+
+    def test_records(self):
+        """Packed records should be read by index and by streaming."""
+        dataset = TensorDataset(torch.arange(10), torch.arange(10) * 2)
+        root = os.path.join(self.tmpdir, "records")
+        data.records.pack_dataset(
+            dataset, root, indices=[7, 1, 3, 5], shard_size=256)
+        records = data.records.RecordDataset(root)
+        self.assertEqual(len(records), 4)
+        self.assertGreater(len(records.shards), 1)
+        self.assertEqual([int(records[idx][1]) for idx in range(4)],
+                         [14, 2, 6, 10])
+        stream = data.records.RecordStream(records, buffer_size=2)
+        self.assertEqual(sorted(int(sample[0]) for sample in stream),
+                         [1, 3, 5, 7])
+
+    def test_expand_channel(self):
+        """Expanded view should equal copied channels."""
+        img = torch.rand(1, 4, 4)
+        copied = data.transforms.ExpandChannel(3)(img)
+        view = data.transforms.ExpandChannel(3, copy=False)(img)
+        self.assertEqual(view.stride(0), 0)
+        self.assertTrue(torch.equal(copied, view))
+        self.assertTrue(torch.equal(copied, torch.cat([img] * 3, 0)))
+
+    def test_batch_transforms(self):
+        """Batch transforms should work on collated batch at once."""
+        batch = torch.rand(8, 1, 5, 5)
+        transform = data.transforms.BatchCompose([
+            data.transforms.BatchExpandChannel(3),
+            data.transforms.BatchRandomFlip(p=1.0),
+            data.transforms.BatchNormalize([0.5] * 3, [0.25] * 3)
+        ])
+        expected = (batch.flip(3).repeat(1, 3, 1, 1) - 0.5) / 0.25
+        self.assertTrue(torch.allclose(transform(batch), expected))
+        transform = data.transforms.BatchCompose([
+            data.transforms.BatchExpandChannel(3),
+            data.transforms.BatchNormalize([0.5] * 3, [0.25] * 3,
+                                           inplace=True)
+        ])
+        expected = (batch.repeat(1, 3, 1, 1) - 0.5) / 0.25
+        self.assertTrue(torch.allclose(transform(batch), expected))
+
+    def test_cached_transform(self):
+        """Cached prefix should be shared by slices of one dataset."""
+        dataset = _DummyImageDataset(10)
+        transform = data.transforms.BatchCompose([
+            lambda path: np.full((2, 2), int(path[:-4]), np.uint8),
+            torch.from_numpy
+        ])
+        prefix, suffix = data.transforms.split_transform(transform, 1)
+        cache_path = os.path.join(self.tmpdir, "cache")
+        train = data.datasets.CachedTransformDataset(
+            data.datasets.SliceDataset(dataset, [1, 3, 5]), prefix, suffix,
+            cache_path)
+        self.assertEqual(train[1][0].tolist(), [[3, 3], [3, 3]])
+        val = data.datasets.CachedTransformDataset(
+            data.datasets.SliceDataset(dataset, [3]), prefix, suffix,
+            cache_path)
+        # cached sample shouldn't be loaded from dataset again
+        dataset.imgs = None
+        self.assertEqual(val[0][0].tolist(), [[3, 3], [3, 3]])
+        self.assertEqual(val[0][1], 0)
+        # store of another dataset with the same size shouldn't be reused
+        other = _DummyImageDataset(10)
+        other.imgs = [("1{}".format(path), label)
+                      for path, label in other.imgs]
+        other = data.datasets.CachedTransformDataset(
+            data.datasets.SliceDataset(other, [3]), prefix, suffix,
+            cache_path)
+        self.assertEqual(other[0][0].tolist(), [[13, 13], [13, 13]])
+
+    def test_cached_transform_reuse(self):
+        """Matching store should be reused without decoding samples."""
+        dataset = _DummyImageDataset(4)
+        calls = []
+
+        def prefix(path):
+            calls.append(path)
+            return np.zeros((2, 2), np.uint8)
+
+        cache_path = os.path.join(self.tmpdir, "cache")
+        data.datasets.CachedTransformDataset(dataset, prefix,
+                                             cache_path=cache_path)
+        cached = data.datasets.CachedTransformDataset(dataset, prefix,
+                                                      cache_path=cache_path)
+        self.assertEqual((len(calls), cached.shape), (1, (2, 2)))
+        empty = data.datasets.CachedTransformDataset(
+            data.datasets.SliceDataset(_DummyImageDataset(0), []), prefix,
+            cache_path=os.path.join(self.tmpdir, "empty"))
+        self.assertEqual(len(empty), 0)
+
+    def test_dataset_stats(self):
+        """Merged statistics should match statistics of all pixels."""
+        images = torch.rand(13, 3, 4, 5)
+        filepath = os.path.join(self.tmpdir, "stats.pt")
+        stats = data.stats.compute_dataset_stats(
+            TensorDataset(images), bins=4, save_path=filepath)
+        pixels = images.transpose(0, 1).reshape(3, -1)
+        self.assertTrue(torch.allclose(stats["mean"], pixels.mean(1)))
+        self.assertTrue(
+            torch.allclose(stats["std"], pixels.std(1, unbiased=False)))
+        self.assertEqual(stats["hist"].sum().item(), pixels.numel())
+        loaded = data.stats.load_dataset_stats(filepath)
+        self.assertTrue(torch.equal(loaded["mean"], stats["mean"]))
+
+    def test_aspect_ratio_sampler(self):
+        """Batches should come from one bucket and be reproducible."""
+        random_state = np.random.RandomState(0)
+        sizes = random_state.randint(100, 500, (100, 2))
+        sampler = data.samplers.AspectRatioBatchSampler(sizes, 8, seed=1)
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        self.assertEqual(sorted(sum(batches, [])), list(range(100)))
+        for batch in batches:
+            self.assertEqual(len(set(sampler.bucket_ids[batch])), 1)
+        self.assertEqual(
+            list(data.samplers.AspectRatioBatchSampler(sizes, 8, seed=1)),
+            batches)
+        shapes = sampler.get_bucket_shapes((224, 224))
+        self.assertTrue((shapes[:-1, 0] >= shapes[1:, 0]).all())
+        dataset = data.datasets.IndexedDataset(
+            [(torch.rand(3, h, w), 0) for h, w in sizes])
+        loader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=data.collate.BucketResizeCollate(sampler, (224, 224)))
+        images, _, indices = next(iter(loader))
+        self.assertEqual(tuple(images.shape[-2:]),
+                         tuple(shapes[sampler.bucket_ids[indices[0]]]))
+
+    def test_buffered_collate(self):
+        """Buffers should be reused only after batches are released."""
+        samples = [(torch.full((3, 2, 2), float(idx)), idx)
+                   for idx in range(4)]
+        collate = data.collate.BufferedCollate(2, (2, 2), num_buffers=1)
+        images, labels = collate(samples[:2])
+        self.assertEqual(labels.tolist(), [0, 1])
+        held = collate(samples[2:])
+        self.assertEqual(collate.stalls, 1)
+        self.assertEqual(images[:, 0, 0, 0].tolist(), [0., 1.])
+        del images, labels
+        images, labels = collate(samples[1:3])
+        self.assertEqual(images[:, 0, 0, 0].tolist(), [1., 2.])
+        self.assertEqual(held[1].tolist(), [2, 3])
+        self.assertEqual(collate.reused, 1)
+        cfg = argparse.Namespace(batch_size=2, image_size=(2, 2),
+                                 num_workers=2)
+        self.assertIs(data.collate.get_buffered_collate(cfg),
+                      data.collate.default_collate)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "CUDA required")
+    def test_buffered_collate_pinned(self):
+        """Pinned buffers should be reused only after being released."""
+        samples = [(torch.zeros(3, 2, 2), idx) for idx in range(2)]
+        collate = data.collate.BufferedCollate(
+            2, (2, 2), num_buffers=1, pin_memory=True)
+        batch = collate(samples)
+        stream = torch.cuda.Stream()
+        with torch.cuda.stream(stream):
+            images = batch[0].cuda(non_blocking=True)
+        collate.release(batch, stream)
+        del batch
+        torch.cuda.synchronize()
+        collate(samples)
+        self.assertEqual(collate.reused, 1)
+        # without release, buffers fall back to unpinned memory
+        collate = data.collate.BufferedCollate(
+            2, (2, 2), num_buffers=1, pin_memory=True)
+        images = collate(samples)
+        with self.assertWarns(UserWarning):
+            collate(samples)
+        self.assertFalse(collate.pin_memory)
+        del images
+
+    def test_loss_aware_sampler(self):
+        """Hard samples should be drawn more often, keeping a floor."""
+        dataset = data.datasets.IndexedDataset(
+            TensorDataset(torch.arange(100), torch.arange(100)))
+        sampler = data.samplers.LossAwareSampler(
+            dataset, fraction=0.5, floor=0.2)
+        self.assertEqual(len(sampler), 50)
+        _, labels, indices = next(iter(DataLoader(dataset, batch_size=100)))
+        sampler.update(indices, (labels >= 90).float())
+        probs = sampler.get_probs()
+        self.assertAlmostEqual(probs.sum().item(), 1.)
+        self.assertAlmostEqual(probs[0].item(), 0.2 / 100)
+        self.assertGreater(probs[95].item(), probs[0].item())
+        self.assertEqual(len(list(sampler)), 50)
+        # sampling for more categories than torch.multinomial supports
+        limit = data.samplers.MULTINOMIAL_MAX_CATEGORIES
+        data.samplers.MULTINOMIAL_MAX_CATEGORIES = 10
+        try:
+            sampler.replacement = False
+            indices = list(sampler)
+            self.assertEqual(len(set(indices)), 50)
+            self.assertGreaterEqual(len(set(indices) & set(range(90, 100))),
+                                    9)
+            sampler.replacement = True
+            self.assertTrue(all(0 <= idx < 100 for idx in sampler))
+        finally:
+            data.samplers.MULTINOMIAL_MAX_CATEGORIES = limit
+
+    def test_distributed_split_sampler(self):
+        """Shards of ranks should be disjoint and equal-sized."""
+        split = data.split_dataset(range(103), seed=0)
+        shards = []
+        for rank in range(4):
+            sampler = data.samplers.DistributedSplitSampler(
+                split["train"], num_replicas=4, rank=rank, seed=1)
+            sampler.set_epoch(2)
+            shards.append(list(sampler))
+        self.assertEqual([len(shard) for shard in shards], [len(sampler)] * 4)
+        self.assertEqual(
+            set(sum(shards, [])), set(split["train"].tolist()))
+        sampler.set_epoch(3)
+        self.assertNotEqual(list(sampler), shards[-1])
+
+    def test_distributed_split_sampler_gloo(self):
+        """Rank and number of replicas should come from process group."""
+        import torch.distributed as dist
+        dist.init_process_group(
+            "gloo",
+            init_method="file://" + os.path.join(self.tmpdir, "store"),
+            rank=0,
+            world_size=1)
+        try:
+            sampler = data.samplers.DistributedSplitSampler(np.arange(10))
+            self.assertEqual(sorted(sampler), list(range(10)))
+        finally:
+            dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,292 @@
+"""Test case for torchsharp.model ."""
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+
+import init_path
+import torchsharp.data as data
+from torchsharp.model.checkpoint import deferred_init, materialize_network
+from torchsharp.model.initializer import get_initializer
+from torchsharp.model.metrics import ConfusionMeter, MultiClassAccMeter
+from torchsharp.model.model import BaseModel
+
+
+class _BufferNet(nn.Module):
+    """Network with a non-persistent buffer computed in __init__."""
+
+    def __init__(self):
+        """Init network."""
+        super(_BufferNet, self).__init__()
+        self.linear = nn.Linear(5, 5)
+        self.register_buffer("index", torch.arange(5).float(),
+                             persistent=False)
+        self.scale = nn.Parameter(torch.ones(2))
+
+
+class Tester(unittest.TestCase):
+    """Tester."""
+
+    def setUp(self):
+        """Create temporary folder and config."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = argparse.Namespace(
+            name="exp",
+            model_root=self.tmpdir,
+            gpu_ids=[],
+            training=True,
+            init_type="normal")
+
+    def tearDown(self):
+        """Remove temporary folder."""
+        shutil.rmtree(self.tmpdir)
+
+    def _build_model(self):
+        """Build model with one network and one data iterator."""
+        dataset = TensorDataset(torch.arange(10))
+        sampler = data.samplers.ResumableRandomSampler(dataset, seed=0)
+        iterator = data.get_inf_iterator(
+            DataLoader(dataset, batch_size=3, sampler=sampler))
+        base = BaseModel()
+        base.initialize(self.cfg)
+        base.setup_network(nn.Linear(2, 2), "net")
+        base.add_data_iterator(iterator, "train")
+        return base, iterator
+
+    def test_resume_data_iterator(self):
+        """Restored data iterator should continue from the next batch."""
+        saved, iterator = self._build_model()
+        list(itertools.islice(iterator, 5))
+        saved.save_networks(1)
+        expected = [batch[0].tolist()
+                    for batch in itertools.islice(iterator, 4)]
+        restored, iterator = self._build_model()
+        restored.restore_networks(1)
+        self.assertEqual([batch[0].tolist()
+                          for batch in itertools.islice(iterator, 4)],
+                         expected)
+
+    def test_setup_network_from_checkpoint(self):
+        """Networks should be set up from consolidated checkpoint."""
+        saved, _ = self._build_model()
+        saved.save_checkpoint(7)
+        base = BaseModel()
+        base.initialize(self.cfg)
+        net = nn.Linear(2, 2)
+        base.setup_network(net, "net", epoch=7, init=True)
+        self.assertTrue(torch.equal(net.weight, saved.net.weight))
+        net = deferred_init(nn.Linear, 2, 2)
+        base.setup_network(net, "deferred", epoch=7, init=True)
+        self.assertFalse(net.weight.is_meta)
+        net = deferred_init(nn.Linear, 2, 2)
+        base.setup_network(net, "net", epoch=7)
+        self.assertTrue(torch.equal(net.weight, saved.net.weight))
+
+    def test_pending_optimizer_state(self):
+        """Optimizer set up after restoring should get restored state."""
+        self.cfg.optimizer = "adam"
+        self.cfg.lr = 0.1
+        self.cfg.beta1 = 0.5
+        self.cfg.lr_policy = "step"
+        self.cfg.lr_decay_epoch = [1]
+        self.cfg.lr_decay_factor = 0.1
+        saved, _ = self._build_model()
+        saved.setup_optimizers()
+        saved.net(torch.ones(1, 2)).sum().backward()
+        saved.optimizers[0].step()
+        saved.schedulers[0].step()
+        saved.save_checkpoint(6)
+        restored, _ = self._build_model()
+        with self.assertWarns(UserWarning):
+            restored.restore_networks(6)
+        restored.setup_optimizers()
+        state = restored.optimizers[0].state_dict()["state"]
+        self.assertTrue(torch.equal(
+            state[0]["exp_avg"],
+            saved.optimizers[0].state_dict()["state"][0]["exp_avg"]))
+        self.assertEqual(restored.schedulers[0].last_epoch, 1)
+
+    def test_consolidated_checkpoint_shuffle(self):
+        """Checkpoint should restore batches of default shuffling."""
+        dataset = TensorDataset(torch.arange(8))
+
+        def build():
+            base = BaseModel()
+            base.initialize(self.cfg)
+            base.setup_network(nn.Linear(2, 2), "net")
+            iterator = data.get_inf_iterator(
+                DataLoader(dataset, batch_size=3, shuffle=True))
+            base.add_data_iterator(iterator, "train")
+            return base, iterator
+
+        saved, iterator = build()
+        list(itertools.islice(iterator, 4))
+        saved.save_checkpoint(1)
+        expected = [batch[0].tolist()
+                    for batch in itertools.islice(iterator, 4)]
+        restored, iterator = build()
+        torch.manual_seed(1234)
+        restored.restore_checkpoint(1)
+        self.assertEqual([batch[0].tolist()
+                          for batch in itertools.islice(iterator, 4)],
+                         expected)
+
+    def test_async_checkpoint(self):
+        """Checkpoint saved in background should match state at saving."""
+        self.cfg.async_checkpoint = True
+        base, _ = self._build_model()
+        expected = {k: v.clone() for k, v in base.net.state_dict().items()}
+        base.save_networks(2)
+        with torch.no_grad():
+            base.net.weight.add_(1)
+        base.wait_checkpoints()
+        restored, _ = self._build_model()
+        restored.restore_networks(2)
+        for key, value in restored.net.state_dict().items():
+            self.assertTrue(torch.equal(value, expected[key]))
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmpdir, "exp"))),
+            ["2-data.pt", "2-net.pt"])
+
+    def test_consolidated_checkpoint(self):
+        """Checkpoint should restore optimizer, data and random states."""
+        saved, iterator = self._build_model()
+        saved.optimizers.append(
+            torch.optim.Adam(saved.net.parameters(), lr=0.1))
+        for batch in itertools.islice(iterator, 2):
+            saved.net(batch[0].float().view(-1, 1).expand(-1, 2)).sum() \
+                .backward()
+            saved.optimizers[0].step()
+        saved.save_checkpoint(3)
+        expected_rand = torch.rand(3)
+        expected_batch = next(iterator)[0].tolist()
+        restored, iterator = self._build_model()
+        restored.optimizers.append(
+            torch.optim.Adam(restored.net.parameters(), lr=0.1))
+        manifest = restored.restore_checkpoint(3)
+        self.assertEqual(manifest["networks"], ["net"])
+        self.assertTrue(torch.equal(torch.rand(3), expected_rand))
+        self.assertEqual(next(iterator)[0].tolist(), expected_batch)
+        self.assertTrue(torch.equal(restored.net.weight, saved.net.weight))
+        state = restored.optimizers[0].state_dict()["state"]
+        self.assertTrue(torch.equal(
+            state[0]["exp_avg"],
+            saved.optimizers[0].state_dict()["state"][0]["exp_avg"]))
+
+    def test_parallel_mmap_restore(self):
+        """Networks should be restored concurrently from mmapped files."""
+        self.cfg.mmap_checkpoint = True
+        saved, _ = self._build_model()
+        saved.setup_network(nn.Linear(3, 3), "head")
+        saved.save_networks(4)
+        restored, _ = self._build_model()
+        restored.setup_network(nn.Linear(3, 3), "head")
+        restored.restore_networks(4)
+        for name in ["net", "head"]:
+            for key, value in getattr(restored, name).state_dict().items():
+                self.assertTrue(torch.equal(
+                    value, getattr(saved, name).state_dict()[key]))
+        self.assertIsNotNone(restored.restore_time)
+
+    def test_deferred_init(self):
+        """Meta network should be materialized from checkpoint."""
+        saved = nn.Linear(2, 2)
+        os.makedirs(os.path.join(self.tmpdir, "exp"))
+        torch.save({"0." + k: v for k, v in saved.state_dict().items()},
+                   os.path.join(self.tmpdir, "exp", "5-seq.pt"))
+        base = BaseModel()
+        base.initialize(self.cfg)
+        net = deferred_init(
+            lambda: nn.Sequential(nn.Linear(2, 2), nn.Linear(2, 3)))
+        self.assertTrue(net[0].weight.is_meta)
+        base.setup_network(net, "seq", epoch=5, init=True)
+        self.assertTrue(torch.equal(net[0].weight, saved.weight))
+        self.assertFalse(any(p.is_meta for p in net.parameters()))
+        self.assertEqual(net(torch.rand(4, 2)).size(), (4, 3))
+
+    def test_deferred_init_buffers(self):
+        """Tensors not in checkpoint should be recomputed, not left empty."""
+        net = deferred_init(
+            lambda: nn.Sequential(_BufferNet(), _BufferNet()))
+        with self.assertWarns(UserWarning):
+            materialize_network(net, {})
+        for module in net:
+            self.assertEqual(module.index.tolist(), [0., 1., 2., 3., 4.])
+            self.assertEqual(module.scale.tolist(), [1., 1.])
+        with torch.device("meta"):
+            net = _BufferNet()
+        with self.assertRaises(RuntimeError):
+            materialize_network(net, {})
+        self.assertTrue(net.scale.is_meta)
+
+    def test_initializer_coverage(self):
+        """Initializer should batch same-shaped layers and report coverage."""
+        net = nn.Sequential(nn.Linear(4, 4), nn.Linear(4, 4),
+                            nn.BatchNorm1d(4), nn.PReLU())
+        coverage = get_initializer("kaiming_uniform")(net)
+        self.assertEqual(coverage["handled"], {
+            "Linear": 2,
+            "BatchNorm1d": 1
+        })
+        self.assertEqual(coverage["unhandled"], {"PReLU": 1})
+        self.assertFalse(torch.equal(net[0].weight, net[1].weight))
+        self.assertLessEqual(net[0].weight.abs().max().item(),
+                             2**0.5 * (3 / 4)**0.5)
+        self.assertEqual(net[2].bias.abs().sum().item(), 0)
+        embedding = nn.Embedding(5, 4, padding_idx=0)
+        get_initializer("xavier_normal")(embedding)
+        self.assertEqual(embedding.weight[0].abs().sum().item(), 0)
+        self.assertNotEqual(embedding.weight[1].abs().sum().item(), 0)
+
+    def test_multi_class_acc_meter(self):
+        """Meter should compute top-1 and top-k accuracy at once."""
+        outputs = torch.tensor([[0.1, 0.5, 0.4], [0.7, 0.2, 0.1],
+                                [0.2, 0.3, 0.5], [0.6, 0.3, 0.1]])
+        meter = MultiClassAccMeter(topk=(1, 2))
+        meter.add(outputs[:2], torch.tensor([1, 1]))
+        meter.add(outputs[2:], torch.tensor([0, 0]))
+        self.assertEqual(meter.average(), [50., 75.])
+        meter = MultiClassAccMeter()
+        meter.add(outputs, torch.tensor([1, 0, 2, 1]))
+        self.assertEqual(meter.average(), 75.)
+        meter.reset()
+        self.assertEqual(meter.average(), 0.)
+        with self.assertRaises(AssertionError):
+            meter.add(torch.rand(2, 3, 4, 4), torch.zeros(2, 4, 4))
+
+    def test_confusion_meter(self):
+        """Meter should derive metrics from confusion matrix."""
+        meter = ConfusionMeter(num_classes=3, ignore_index=255)
+        # segmentation scores of size [N x C x H x W]
+        outputs = torch.zeros(1, 3, 2, 2)
+        outputs[0, :, 0, 0] = torch.tensor([1., 0., 0.])
+        outputs[0, :, 0, 1] = torch.tensor([0., 1., 0.])
+        outputs[0, :, 1, 0] = torch.tensor([0., 1., 0.])
+        outputs[0, :, 1, 1] = torch.tensor([0., 0., 1.])
+        meter.add(outputs, torch.tensor([[[0, 1], [0, 255]]]))
+        meter.add(torch.tensor([2]), torch.tensor([2]))
+        self.assertEqual(meter.confusion().tolist(),
+                         [[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+        self.assertEqual(meter.recall().tolist(), [0.5, 1., 1.])
+        self.assertEqual(meter.precision().tolist(), [1., 0.5, 1.])
+        self.assertAlmostEqual(meter.mean_iou(), 2 / 3)
+        metrics = meter.average()
+        self.assertAlmostEqual(metrics["accuracy"], 75.)
+        self.assertAlmostEqual(metrics["balanced_accuracy"], 250. / 3)
+        self.assertAlmostEqual(metrics["f1"], 700. / 9)
+        meter.reset()
+        meter.add(torch.tensor([0, 1, 0, 1, 7]), torch.tensor([0, 0, 0, 0, 2]))
+        self.assertAlmostEqual(meter.mean_iou(), 0.25)
+        self.assertAlmostEqual(meter.average()["miou"], 25.)
+        self.assertEqual(meter.recall()[2].item(), 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,2 +1,3 @@
-from . import datasets, transforms
+from . import (collate, datasets, iterators, loaders, records, samplers,
+               stats, transforms)
 from ._utils import *
@@ -5,6 +5,8 @@ import os
 import numpy as np
 import torch
 
+from .iterators import InfIterator
+
 
 def denormalize(x, std, mean):
     """Invert normalization, and then convert array into image."""
@@ -13,10 +15,12 @@ def denormalize(x, std, mean):
 
 
 def get_inf_iterator(data_loader):
-    """Inf dataset iterator."""
-    while True:
-        for images, labels in data_loader:
-            yield (images, labels)
+    """Inf dataset iterator.
+
+    The returned InfIterator can save and restore its position by
+    `state_dict()` and `load_state_dict()`.
+    """
+    return InfIterator(data_loader)
 
 
 def cv2_loader(path):
@@ -28,36 +32,125 @@ def cv2_loader(path):
     return cv2.imread(path)
 
 
+def probe_video(filepath):
+    """Probe shape and frame rate of video without decoding its frames.
+
+    Args:
+        filepath (str): path to video file.
+
+    Returns:
+        tuple: (num_frames, height, width, channels, fps)
+    """
+    import skvideo.io
+    reader = skvideo.io.FFmpegReader(filepath)
+    num_frames, height, width, channels = reader.getShape()
+    fps = float(reader.inputfps)
+    reader.close()
+    return num_frames, height, width, channels, fps
+
+
+def _get_random_state(seed=None):
+    """Get numpy random state, or the global one if seed is not given."""
+    if seed is None:
+        return np.random
+    return np.random.RandomState(seed)
+
+
+def _get_index_dtype(num_samples):
+    """Get the most compact integer type for indices of dataset."""
+    if num_samples <= np.iinfo(np.int32).max + 1:
+        return np.int32
+    return np.int64
+
+
+def _rank_by_label(order, labels):
+    """Group ordered indices by label.
+
+    Args:
+        order (numpy.ndarray): ordered indices of samples.
+        labels (numpy.ndarray, optional): labels of all samples.
+
+    Returns:
+        tuple: (grouped, rank, count), where grouped is `order` stably
+            sorted by label, rank is position of each grouped sample in its
+            class and count is size of its class.
+    """
+    if labels is None:
+        return order, np.arange(len(order)), np.full(len(order), len(order))
+    grouped = order[np.argsort(labels[order], kind="stable")]
+    grouped_labels = labels[grouped]
+    _, starts, counts = np.unique(
+        grouped_labels, return_index=True, return_counts=True)
+    class_idx = np.repeat(np.arange(len(starts)), counts)
+    rank = np.arange(len(grouped)) - starts[class_idx]
+    return grouped, rank, counts[class_idx]
+
+
 def split_dataset(dataset,
                   trainval_rate=0.7,
                   train_rate=0.9,
                   shuffle=True,
                   save_split=False,
-                  save_path="dataset_split.pt"):
-    """Split dataset into train/val/test subset."""
-    all_indices = list(range(len(dataset)))
+                  save_path="dataset_split.pt",
+                  labels=None,
+                  keys=None,
+                  seed=None):
+    """Split dataset into train/val/test subset.
+
+    All subsets are integer index arrays computed in linear time.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to be split.
+        trainval_rate (float, optional): rate of train and val samples.
+        train_rate (float, optional): rate of train samples in trainval.
+        shuffle (bool, optional): whether to shuffle samples.
+        save_split (bool, optional): whether to save split into file.
+        save_path (str, optional): path to save split.
+        labels (array_like, optional): labels of all samples, split within
+            every class (stratified) if given.
+        keys (list, optional): unique names of all samples (e.g. image
+            paths). If given, split samples by hash of keys, which keeps
+            subset of each sample unchanged when dataset grows.
+        seed (int, optional): random seed, use numpy global random state
+            if not given.
+
+    Returns:
+        dict: indices of "all", "trainval", "train", "val" and "test".
+    """
+    if keys is not None:
+        return hash_split(
+            keys, trainval_rate, train_rate, save_split=save_split,
+            save_path=save_path)
+
+    num_samples = len(dataset)
+    all_indices = np.arange(num_samples, dtype=_get_index_dtype(num_samples))
     if shuffle:
-        np.random.shuffle(all_indices)
+        _get_random_state(seed).shuffle(all_indices)
+    if labels is not None:
+        labels = np.asarray(labels)
 
-    # get number of images in subsets
-    num_test = int(np.ceil((1 - trainval_rate) * len(all_indices)))
-    num_trainval = len(all_indices) - num_test
-    num_train = int(np.floor(train_rate * num_trainval))
+    # get number of samples in subsets (per class if stratified)
+    grouped, rank, count = _rank_by_label(all_indices, labels)
+    num_test = np.ceil((1 - trainval_rate) * count).astype(np.int64)
+    num_trainval = count - num_test
+    num_train = np.floor(train_rate * num_trainval).astype(np.int64)
     num_val = num_trainval - num_train
 
-    # get indices of subsets
-    test_idx = all_indices[:num_test]
-    trainval_indices = [x for x in all_indices if x not in test_idx]
-    train_idx = trainval_indices[num_val:]
-    val_idx = trainval_indices[:num_val]
+    # get indices of subsets, keeping the order of all indices
+    is_test = np.zeros(num_samples, dtype=bool)
+    is_test[grouped[rank < num_test]] = True
+    is_val = np.zeros(num_samples, dtype=bool)
+    is_val[grouped[(rank >= num_test) & (rank < num_test + num_val)]] = True
+    is_test = is_test[all_indices]
+    is_val = is_val[all_indices]
 
     # add to dict
     split_indices = {
         "all": all_indices,
-        "trainval": trainval_indices,
-        "train": train_idx,
-        "val": val_idx,
-        "test": test_idx
+        "trainval": all_indices[~is_test],
+        "train": all_indices[~is_test & ~is_val],
+        "val": all_indices[is_val],
+        "test": all_indices[is_test]
     }
 
     # save data split
@@ -67,30 +160,177 @@ def split_dataset(dataset,
     return split_indices
 
 
+def kfold_split(dataset,
+                num_folds=5,
+                num_repeats=1,
+                shuffle=True,
+                save_split=False,
+                save_path="dataset_split.pt",
+                labels=None,
+                seed=None):
+    """Split dataset into k folds for cross validation.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to be split.
+        num_folds (int, optional): number of folds.
+        num_repeats (int, optional): times to repeat k-fold splitting,
+            with different shuffling each time.
+        shuffle (bool, optional): whether to shuffle samples.
+        save_split (bool, optional): whether to save split into file.
+        save_path (str, optional): path to save split.
+        labels (array_like, optional): labels of all samples, keep the
+            ratio of classes in every fold (stratified) if given.
+        seed (int, optional): random seed, use numpy global random state
+            if not given.
+
+    Returns:
+        list: `num_repeats` x `num_folds` dicts with indices of "train" and
+            "val", in order of repeats.
+    """
+    num_samples = len(dataset)
+    dtype = _get_index_dtype(num_samples)
+    random_state = _get_random_state(seed)
+    if labels is not None:
+        labels = np.asarray(labels)
+
+    folds = []
+    for _ in range(num_repeats):
+        all_indices = np.arange(num_samples, dtype=dtype)
+        if shuffle:
+            random_state.shuffle(all_indices)
+        # deal samples class by class to folds in round robin
+        grouped, _, _ = _rank_by_label(all_indices, labels)
+        fold_ids = np.empty(num_samples, dtype=np.int64)
+        fold_ids[grouped] = np.arange(num_samples) % num_folds
+        fold_ids = fold_ids[all_indices]
+        for fold in range(num_folds):
+            is_val = fold_ids == fold
+            folds.append({
+                "train": all_indices[~is_val],
+                "val": all_indices[is_val]
+            })
+
+    # save data split
+    if save_split:
+        save_dataset_split(folds, save_path)
+
+    return folds
+
+
+def hash_split(keys,
+               trainval_rate=0.7,
+               train_rate=0.9,
+               save_split=False,
+               save_path="dataset_split.pt"):
+    """Split samples deterministically by hash of their keys.
+
+    Every sample is assigned to subset only by its own key, so that it stays
+    in the same subset when new samples are added to dataset.
+
+    Args:
+        keys (list): unique names of all samples (e.g. image paths).
+        trainval_rate (float, optional): rate of train and val samples.
+        train_rate (float, optional): rate of train samples in trainval.
+        save_split (bool, optional): whether to save split into file.
+        save_path (str, optional): path to save split.
+
+    Returns:
+        dict: indices of "all", "trainval", "train", "val" and "test".
+    """
+    import hashlib
+    digests = b"".join(
+        hashlib.md5(str(key).encode("utf-8")).digest()[:8] for key in keys)
+    # map first 8 bytes of digests to uniform values in [0, 1)
+    values = np.frombuffer(digests, dtype=">u8") / 2.0**64
+    all_indices = np.arange(len(values), dtype=_get_index_dtype(len(values)))
+    test_bound = 1 - trainval_rate
+    val_bound = test_bound + trainval_rate * (1 - train_rate)
+    is_test = values < test_bound
+    is_val = ~is_test & (values < val_bound)
+
+    # add to dict
+    split_indices = {
+        "all": all_indices,
+        "trainval": all_indices[~is_test],
+        "train": all_indices[~is_test & ~is_val],
+        "val": all_indices[is_val],
+        "test": all_indices[is_test]
+    }
+
+    # save data split
+    if save_split:
+        save_dataset_split(split_indices, save_path)
+
+    return split_indices
+
+
+def _map_split(split_indices, func):
+    """Apply function to all index arrays in (list of) split dict."""
+    if isinstance(split_indices, dict):
+        return {k: func(v) for k, v in split_indices.items()}
+    return [_map_split(item, func) for item in split_indices]
+
+
+def _to_index_tensor(indices):
+    """Convert indices into tensor of the most compact integer type."""
+    indices = np.asarray(indices, dtype=np.int64)
+    num_samples = int(indices.max()) + 1 if len(indices) > 0 else 0
+    return torch.from_numpy(indices.astype(_get_index_dtype(num_samples)))
+
+
 def save_dataset_split(split_indices, filepath):
-    """Save splited dataset indices."""
-    if os.path.exists(os.path.dirname(filepath)):
+    """Save splited dataset indices as compact integer tensors."""
+    dirname = os.path.dirname(filepath)
+    if not dirname or os.path.exists(dirname):
+        split_indices = _map_split(split_indices, _to_index_tensor)
         torch.save(split_indices, filepath)
 
 
 def load_dataset_split(filepath):
-    """Load splited dataset indices."""
+    """Load splited dataset indices as numpy arrays."""
     split_indices = None
     if os.path.exists(filepath):
-        split_indices = torch.load(filepath)
+        split_indices = _map_split(
+            torch.load(filepath),
+            lambda x: x.numpy() if torch.is_tensor(x) else np.asarray(x))
     return split_indices
 
 
+def get_labels(images):
+    """Get labels of samples as numpy array.
+
+    Args:
+        images (list or array_like): list of (path, label) tuples like
+            `ImageFolder.imgs`, or labels of samples.
+
+    Returns:
+        numpy.ndarray: labels of samples.
+    """
+    if torch.is_tensor(images):
+        return images.cpu().numpy()
+    if isinstance(images, np.ndarray):
+        return images
+    if len(images) > 0 and isinstance(images[0], (tuple, list)):
+        return np.fromiter(
+            (item[1] for item in images), dtype=np.int64, count=len(images))
+    return np.asarray(images, dtype=np.int64)
+
+
 def get_balanced_weights(images, num_classes):
-    """Get weights for WeightedRandomSampler on classes balancing."""
-    count = [0] * num_classes
-    for item in images:
-        count[item[1]] += 1
-    weight_per_class = [0.] * num_classes
-    N = float(sum(count))
-    for i in range(num_classes):
-        weight_per_class[i] = N / float(count[i])
-    weight = [0] * len(images)
-    for idx, val in enumerate(images):
-        weight[idx] = weight_per_class[val[1]]
-    return weight
+    """Get weights for WeightedRandomSampler on classes balancing.
+
+    Args:
+        images (list or array_like): list of (path, label) tuples like
+            `ImageFolder.imgs`, or labels of samples.
+        num_classes (int): number of classes.
+
+    Returns:
+        torch.DoubleTensor: weight of each sample, which is inversely
+            proportional to the size of its class.
+    """
+    labels = get_labels(images)
+    count = np.bincount(labels, minlength=num_classes).astype(np.float64)
+    # classes without any samples get zero weight
+    weight_per_class = np.divide(
+        float(len(labels)), count, out=np.zeros_like(count), where=count > 0)
+    return torch.from_numpy(weight_per_class[labels])
@@ -0,0 +1,250 @@
+"""Collate functions for data loader."""
+
+import warnings
+import weakref
+
+import torch
+import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
+
+
+class BufferedCollate(object):
+    """Collate (image, label) samples into a ring of preallocated buffers.
+
+    Images and labels are written straight into reusable (optionally
+    pinned) batch buffers instead of allocating new tensors for every
+    batch. A buffer is reused only after the batch returned from it is
+    released by caller, otherwise a new batch is allocated and counted as
+    a stall. Hold on to batch tensors themselves rather than views of them,
+    since views are not tracked.
+
+    Pinned batches may still be read by asynchronous copies to GPU after
+    they are dropped, e.g. by `images = images.cuda(non_blocking=True)`,
+    so pinned buffers are reused only after `release()` is called with the
+    batch after copies are issued, and the copies are done. If the ring
+    stalls before `release()` is ever called, buffers fall back to
+    unpinned memory tracked by references, with a warning.
+
+    Buffers can't be shared with the main process safely, so batches are
+    collated without buffers in DataLoader workers. Use it with
+    `num_workers=0`, or to collate lists of samples in main process.
+
+    Args:
+        batch_size (int): size of mini-batch.
+        image_size (sequence): (height, width) of images.
+        channels (int, optional): number of image channels.
+        num_buffers (int, optional): number of buffers in ring.
+        pin_memory (bool, optional): whether to allocate pinned buffers.
+        dtype (torch.dtype, optional): data type of images.
+    """
+
+    def __init__(self,
+                 batch_size,
+                 image_size,
+                 channels=3,
+                 num_buffers=4,
+                 pin_memory=False,
+                 dtype=torch.float32):
+        """Init collate function."""
+        super(BufferedCollate, self).__init__()
+        self.batch_size = batch_size
+        self.image_shape = (channels, ) + tuple(image_size)
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.dtype = dtype
+        self.reused = 0
+        self.allocated = 0
+        self.stalls = 0
+        self.unbuffered = 0
+        self._buffers = []
+        self._outputs = []
+        self._events = []
+        self._cursor = 0
+        self._release_used = False
+
+    def __call__(self, batch):
+        """Collate list of samples."""
+        if not self._is_bufferable(batch):
+            self.unbuffered += 1
+            return default_collate(batch)
+        images, labels = self._get_buffer(len(batch))
+        torch.stack([sample[0] for sample in batch], out=images)
+        for idx, sample in enumerate(batch):
+            labels[idx] = sample[1]
+        return images, labels
+
+    def __getstate__(self):
+        """Drop buffers, which are never shared with workers."""
+        state = self.__dict__.copy()
+        state["_buffers"] = []
+        state["_outputs"] = []
+        state["_events"] = []
+        state["_cursor"] = 0
+        return state
+
+    def release(self, batch, stream=None):
+        """Release pinned batch once copies issued on stream end.
+
+        Args:
+            batch (tuple or torch.Tensor): batch returned by collate, or its
+                images.
+            stream (torch.cuda.Stream, optional): stream of copies, e.g.
+                side stream of `PrefetchIterator`, defaults to current
+                stream.
+        """
+        self._release_used = True
+        images = batch[0] if isinstance(batch, (tuple, list)) else batch
+        ptr = images.untyped_storage().data_ptr()
+        for slot, (buffer, _) in enumerate(self._buffers):
+            if buffer.untyped_storage().data_ptr() == ptr:
+                event = torch.cuda.Event()
+                event.record(stream)
+                self._events[slot] = event
+                return
+
+    def stats(self):
+        """Get counters of buffer reuse and stalls."""
+        return {
+            "reused": self.reused,
+            "allocated": self.allocated,
+            "stalls": self.stalls,
+            "unbuffered": self.unbuffered
+        }
+
+    def _is_bufferable(self, batch):
+        """Check if batch can be collated into buffers."""
+        if data.get_worker_info() is not None or len(batch) == 0:
+            return False
+        if len(batch) > self.batch_size:
+            return False
+        for sample in batch:
+            if not (isinstance(sample, (tuple, list)) and len(sample) == 2 and
+                    torch.is_tensor(sample[0]) and
+                    tuple(sample[0].shape) == self.image_shape and
+                    sample[0].dtype == self.dtype and
+                    not torch.is_tensor(sample[1])):
+                return False
+        return True
+
+    def _allocate(self, size):
+        """Allocate images and labels buffers."""
+        self.allocated += 1
+        images = torch.empty(
+            (size, ) + self.image_shape,
+            dtype=self.dtype,
+            pin_memory=self.pin_memory)
+        labels = torch.empty(
+            size, dtype=torch.int64, pin_memory=self.pin_memory)
+        return images, labels
+
+    def _get_buffer(self, size):
+        """Get next free buffer in ring, or allocate one if it's in use."""
+        if len(self._buffers) < self.num_buffers:
+            self._buffers.append(self._allocate(self.batch_size))
+            self._outputs.append(None)
+            self._events.append(None)
+            slot = len(self._buffers) - 1
+        else:
+            slot = self._cursor
+            if not self._is_free(slot):
+                self.stalls += 1
+                if self.pin_memory and not self._release_used:
+                    self._unpin()
+                return self._allocate(size)
+            self.reused += 1
+        self._cursor = (slot + 1) % self.num_buffers
+        # return new views of buffers to track whether they're released
+        images, labels = self._buffers[slot]
+        images, labels = images[:size], labels[:size]
+        self._outputs[slot] = (weakref.ref(images), weakref.ref(labels))
+        self._events[slot] = None
+        return images, labels
+
+    def _unpin(self):
+        """Fall back to unpinned buffers since release() isn't used.
+
+        Pinned memory dropped here is not reused by torch until pending
+        copies from it end.
+        """
+        warnings.warn("release() of BufferedCollate is never called, fall "
+                      "back to unpinned buffers")
+        self.pin_memory = False
+        self._buffers = []
+        self._outputs = []
+        self._events = []
+        self._cursor = 0
+
+    def _is_free(self, slot):
+        """Check if buffer is released and not read by copies any more."""
+        if self.pin_memory:
+            event = self._events[slot]
+            return event is not None and event.query()
+        outputs = self._outputs[slot]
+        return outputs is None or all(ref() is None for ref in outputs)
+
+
+class BucketResizeCollate(object):
+    """Collate samples of an aspect ratio bucket into images of one shape.
+
+    Works with `AspectRatioBatchSampler` and a dataset wrapped by
+    `IndexedDataset`: every image tensor of [C x H x W] is resized to the
+    shape of its bucket from `get_bucket_shapes()`, looked up by sample
+    index, so that images of a batch can be stacked.
+
+    Args:
+        sampler (AspectRatioBatchSampler): batch sampler of data loader.
+        image_size (sequence): (height, width) like `cfg.image_size`.
+        multiple (int, optional): round height and width to multiple.
+        mode (str, optional): interpolation mode of resizing.
+    """
+
+    def __init__(self, sampler, image_size, multiple=32, mode="bilinear"):
+        """Init collate function."""
+        super(BucketResizeCollate, self).__init__()
+        self.bucket_ids = sampler.bucket_ids
+        self.shapes = sampler.get_bucket_shapes(image_size, multiple)
+        self.mode = mode
+
+    def __call__(self, batch):
+        """Collate list of (image, label, index) samples."""
+        images, labels, indices = zip(*batch)
+        shape = tuple(int(x) for x in self.shapes[self.bucket_ids[indices[0]]])
+        images = [self._resize(image, shape) for image in images]
+        return default_collate(list(zip(images, labels, indices)))
+
+    def _resize(self, image, shape):
+        """Resize image tensor of [C x H x W] to shape."""
+        if tuple(image.shape[-2:]) == shape:
+            return image
+        align_corners = False if self.mode in ("bilinear", "bicubic") \
+            else None
+        resized = torch.nn.functional.interpolate(
+            image.unsqueeze(0).float(),
+            size=shape,
+            mode=self.mode,
+            align_corners=align_corners).squeeze(0)
+        if not image.dtype.is_floating_point:
+            info = torch.iinfo(image.dtype)
+            resized = resized.round().clamp(info.min, info.max)
+        return resized.to(image.dtype)
+
+
+def get_buffered_collate(cfg, num_buffers=4, pin_memory=None):
+    """Get BufferedCollate sized by `cfg.batch_size` and `cfg.image_size`.
+
+    Buffers are only used in main process, so `default_collate` is returned
+    for `cfg.num_workers > 0`, where workers collate batches into shared
+    memory anyway. With pinned buffers, call `release()` of it with every
+    batch after copying the batch to GPU.
+    """
+    if getattr(cfg, "num_workers", 0) > 0:
+        print("use default collate since batches are collated in {} "
+              "workers".format(cfg.num_workers))
+        return default_collate
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    return BufferedCollate(
+        cfg.batch_size,
+        cfg.image_size,
+        num_buffers=num_buffers,
+        pin_memory=pin_memory)
@@ -1,50 +1,212 @@
 """Several useful dummy dataset."""
 
+import hashlib
+import json
 import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import torch
 import torch.utils.data as data
 
+from ._utils import get_labels, probe_video
+
 
 class SliceDataset(data.Dataset):
     """Slice dataset.
 
     That's useful when you need only a part of one dataset
     and want to use other sampler on it instead of SubsetRandomSampler.
+
+    Excerpt and labels of samples are kept in numpy arrays rather than
+    Python lists, which avoids copy-on-write of pages in forked DataLoader
+    workers. Slice of SliceDataset is collapsed into single index mapping
+    on the original dataset.
     """
 
     def __init__(self, original_dataset, excerpt):
         """Init SliceDataset."""
         super(SliceDataset, self).__init__()
+        excerpt = np.asarray(excerpt, dtype=np.int64)
+        if isinstance(original_dataset, SliceDataset):
+            excerpt = original_dataset.excerpt[excerpt]
+            original_dataset = original_dataset.dataset
         self.dataset = original_dataset
         self.excerpt = excerpt
-        self.imgs = [self.dataset.imgs[idx] for idx in self.excerpt]
-        self.classes = self.dataset.classes
+        self.targets = self._get_targets()
+        self.classes = getattr(self.dataset, "classes", None)
 
     def __getitem__(self, index):
         """Get image and target for data loader."""
-        image, label = self.dataset[self.excerpt[index]]
+        image, label = self.dataset[int(self.excerpt[index])]
         return image, label
 
     def __len__(self):
         """Return size of dataset."""
         return len(self.excerpt)
 
+    @property
+    def imgs(self):
+        """Get list of (path, label) tuples of samples in excerpt.
+
+        The list is built on every access, use `targets` for labels.
+        """
+        imgs = self.dataset.imgs
+        return [imgs[idx] for idx in self.excerpt]
+
+    def _get_targets(self):
+        """Get labels of samples in excerpt as numpy array."""
+        if hasattr(self.dataset, "targets"):
+            targets = get_labels(self.dataset.targets)
+        elif hasattr(self.dataset, "imgs"):
+            targets = get_labels(self.dataset.imgs)
+        else:
+            return None
+        return targets[self.excerpt]
+
+
+class IndexedDataset(data.Dataset):
+    """Dataset appending index to each sample.
+
+    That's useful when per-sample statistics (e.g. losses for
+    LossAwareSampler) need to be reported back by index.
+    """
+
+    def __init__(self, original_dataset):
+        """Init IndexedDataset."""
+        super(IndexedDataset, self).__init__()
+        self.dataset = original_dataset
+
+    def __getitem__(self, index):
+        """Get image, target and index for data loader."""
+        image, label = self.dataset[index]
+        return image, label, index
+
+    def __len__(self):
+        """Return size of dataset."""
+        return len(self.dataset)
+
+
+class _VideoStream(object):
+    """Sequential frame reader of video which seeks only when necessary.
+
+    The underlying ffmpeg process is kept open between reads, so reading
+    consecutive ranges of frames costs no extra seeking. By default frame
+    position is converted to timestamp by `fps`, which is fast but only
+    accurate for constant frame rate videos. With `exact_seek`, frames are
+    selected by their number instead, which is right for variable frame
+    rate videos but decodes all frames before the position.
+    """
+
+    def __init__(self, filepath, fps, exact_seek=False):
+        """Init stream."""
+        super(_VideoStream, self).__init__()
+        self.filepath = filepath
+        self.fps = fps
+        self.exact_seek = exact_seek
+        self.position = None
+        self._reader = None
+        self._frames = None
+
+    def seek(self, position):
+        """Re-open video at given frame position."""
+        import skvideo.io
+        self.close()
+        inputdict, outputdict = None, None
+        if position > 0 and self.exact_seek:
+            outputdict = {
+                "-vf": "select=gte(n\\,{})".format(position),
+                "-vsync": "0"
+            }
+        elif position > 0:
+            inputdict = {"-ss": "{:.6f}".format(position / self.fps)}
+        self._reader = skvideo.io.FFmpegReader(
+            self.filepath, inputdict=inputdict, outputdict=outputdict)
+        self._frames = self._reader.nextFrame()
+        self.position = position
+
+    def read(self, start, count):
+        """Read `count` frames from frame `start` (N x H x W x C)."""
+        if self._reader is None or self.position != start:
+            self.seek(start)
+        frames = []
+        for frame in self._frames:
+            frames.append(frame)
+            if len(frames) == count:
+                break
+        self.position += len(frames)
+        return np.asarray(frames, dtype=np.uint8)
+
+    def close(self):
+        """Close underlying reader."""
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = None
+        self._frames = None
+        self.position = None
+
 
 class VideoDataset(data.Dataset):
-    """Dummy dataset for frames in single video."""
+    """Dummy dataset for frames in single video.
+
+    By default all frames are decoded into memory at once. For long videos,
+    set `streaming` to decode frames lazily in chunks of `chunk_size` frames.
+    Decoded chunks are kept in a LRU window so that decoded frames (including
+    the chunk being read ahead) never exceed `memory_budget` bytes. Random
+    access seeks to the requested chunk, while sequential access keeps the
+    decoder open and reads the next chunk ahead in background.
+
+    If `cache_dir` is given, frames are decoded only once into an uint8
+    frame store under that folder, keyed by path, mtime and size of video.
+    The store is memory-mapped, so later runs and all DataLoader workers
+    share the same page cache instead of decoding their own copies.
+    """
 
-    def __init__(self, filepath, transform=None):
-        """Init VideoDataset dataset."""
+    def __init__(self,
+                 filepath,
+                 transform=None,
+                 streaming=False,
+                 chunk_size=64,
+                 memory_budget=512 * 1024**2,
+                 cache_dir=None):
+        """Init VideoDataset dataset.
+
+        Args:
+            filepath (str): path to video file.
+            transform (callable, optional): transform applied to frames.
+            streaming (bool, optional): whether to decode frames lazily.
+            chunk_size (int, optional): max number of frames per chunk.
+            memory_budget (int, optional): bytes of decoded frames to keep
+                in streaming mode.
+            cache_dir (str, optional): folder of memory-mapped frame store.
+        """
         super(VideoDataset, self).__init__()
         self.filepath = filepath
         self.num_frames = None
         self.transform = transform
         self.frames = None
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.cache_path = None
+        self.max_chunks = None
+        self.frame_shape = None
+        self.fps = None
+        self._init_stream()
         self.decode()
 
     def __getitem__(self, index):
         """Get frames from video."""
-        frame = self.frames[index, ...]
+        if self.frames is not None:
+            frame = self.frames[index, ...]
+            if isinstance(frame, np.memmap):
+                # detach frame from read-only frame store
+                frame = np.array(frame)
+        else:
+            frame = self.get_frame(index)
         if self.transform is not None:
             frame = self.transform(frame)
         return index, frame
@@ -53,13 +215,500 @@ class VideoDataset(data.Dataset):
         """Get number of the frames."""
         return self.num_frames
 
+    def __getstate__(self):
+        """Drop decoder states, which can't be shared between workers."""
+        state = self.__dict__.copy()
+        for key in ("_stream", "_chunks", "_executor", "_pending"):
+            state.pop(key)
+        # re-map frame store in workers rather than pickling its content
+        if self.cache_path is not None:
+            state["frames"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore dataset with fresh decoder states."""
+        self.__dict__.update(state)
+        self._init_stream()
+        if self.cache_path is not None:
+            self.frames = self._load_cache()
+
     def decode(self):
         """Decode frames from video."""
         import skvideo.io
-        if os.path.exists(self.filepath):
+        if not os.path.exists(self.filepath):
+            raise IOError("video file doesn't exist: {}".format(self.filepath))
+        if self.cache_dir is not None:
+            self.cache_path = self._get_cache_path()
+            if not os.path.exists(self.cache_path + ".json"):
+                self._build_cache()
+            self.frames = self._load_cache()
+            self.num_frames = self.frames.shape[0]
+            self.frame_shape = self.frames.shape[1:]
+        elif self.streaming:
+            # only probe meta info, frames are decoded on demand
+            num_frames, height, width, channels, fps = probe_video(
+                self.filepath)
+            self.num_frames = num_frames
+            self.frame_shape = (height, width, channels)
+            self.fps = fps
+            # keep at least two chunks (current one and the read-ahead one)
+            # within memory budget
+            frame_bytes = height * width * channels
+            self.chunk_size = max(
+                1, min(self.chunk_size,
+                       self.memory_budget // (2 * frame_bytes)))
+            chunk_bytes = self.chunk_size * frame_bytes
+            self.max_chunks = max(1, self.memory_budget // chunk_bytes - 1)
+            self._init_stream()
+        else:
             self.frames = skvideo.io.vread(self.filepath)
             # return numpy.ndarray (N x H x W x C)
             self.frames = skvideo.utils.vshape(self.frames)
             self.num_frames = self.frames.shape[0]
+
+    def get_frame(self, index):
+        """Get single frame (H x W x C) in streaming mode."""
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError("frame index out of range: {}".format(index))
+        chunk_idx = index // self.chunk_size
+        chunk = self._get_chunk(chunk_idx)
+        return chunk[index - chunk_idx * self.chunk_size]
+
+    def close(self):
+        """Release decoder and decoded chunks in streaming mode."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._stream.close()
+        self._init_stream()
+
+    def _get_cache_path(self):
+        """Get path prefix of frame store keyed by path, mtime and size."""
+        filepath = os.path.abspath(self.filepath)
+        stat = os.stat(filepath)
+        key = "{}:{}:{}".format(filepath, stat.st_mtime_ns, stat.st_size)
+        filename = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, filename)
+
+    def _build_cache(self):
+        """Decode video chunk by chunk into frame store.
+
+        Frames are written to a temporary file and renamed afterwards,
+        the meta file is written last and marks the store as complete.
+        """
+        num_frames, height, width, channels, fps = probe_video(self.filepath)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        stream = _VideoStream(self.filepath, fps)
+        tmp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        count = 0
+        with open(tmp_path, "wb") as f:
+            while count < num_frames:
+                frames = stream.read(
+                    count, min(self.chunk_size, num_frames - count))
+                if len(frames) == 0:
+                    break
+                f.write(frames.tobytes())
+                count += len(frames)
+        stream.close()
+        os.replace(tmp_path, self.cache_path + ".frames")
+        meta = {
+            "filepath": os.path.abspath(self.filepath),
+            "shape": [count, height, width, channels],
+            "fps": fps
+        }
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.cache_path + ".json")
+        print("cache {} frames of {} to {}".format(count, self.filepath,
+                                                   self.cache_path))
+
+    def _load_cache(self):
+        """Memory-map frame store (N x H x W x C)."""
+        with open(self.cache_path + ".json") as f:
+            meta = json.load(f)
+        self.fps = meta["fps"]
+        return np.memmap(
+            self.cache_path + ".frames",
+            dtype=np.uint8,
+            mode="r",
+            shape=tuple(meta["shape"]))
+
+    def _init_stream(self):
+        """Init states for streaming mode."""
+        self._stream = _VideoStream(self.filepath, self.fps)
+        self._chunks = OrderedDict()
+        self._executor = None
+        self._pending = None
+        self._last_chunk = None
+
+    def _get_chunk(self, chunk_idx):
+        """Get decoded chunk from LRU window, or decode it."""
+        sequential = (self._last_chunk is not None and
+                      chunk_idx == self._last_chunk + 1)
+        self._last_chunk = chunk_idx
+        if chunk_idx in self._chunks:
+            self._chunks.move_to_end(chunk_idx)
         else:
-            raise IOError("video file doesn't exist: {}".format(self.filepath))
+            self._collect_pending()
+            if chunk_idx not in self._chunks:
+                self._add_chunk(chunk_idx, self._decode_chunk(chunk_idx))
+        chunk = self._chunks[chunk_idx]
+        if sequential:
+            self._read_ahead(chunk_idx + 1)
+        return chunk
+
+    def _decode_chunk(self, chunk_idx):
+        """Decode all frames in chunk."""
+        start = chunk_idx * self.chunk_size
+        count = min(self.chunk_size, self.num_frames - start)
+        return self._stream.read(start, count)
+
+    def _add_chunk(self, chunk_idx, chunk):
+        """Add chunk to LRU window and evict the least recently used ones."""
+        self._chunks[chunk_idx] = chunk
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+
+    def _read_ahead(self, chunk_idx):
+        """Decode chunk in background thread."""
+        if (chunk_idx * self.chunk_size >= self.num_frames or
+                chunk_idx in self._chunks or self._pending is not None):
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        future = self._executor.submit(self._decode_chunk, chunk_idx)
+        self._pending = (chunk_idx, future)
+
+    def _collect_pending(self):
+        """Wait for chunk being read ahead and add it to LRU window."""
+        if self._pending is not None:
+            chunk_idx, future = self._pending
+            self._pending = None
+            self._add_chunk(chunk_idx, future.result())
+
+
+class VideoClipDataset(data.Dataset):
+    """Dataset for fixed-length clips over multiple videos.
+
+    Clips of `clip_len` frames start every `stride` frames in each video.
+    The global index only keeps number of frames and frame rate per video
+    in arrays, clip index is mapped to (video, start frame) by searching
+    cumulative clip offsets. Clips are decoded on demand by seeking,
+    so a clip costs `clip_len` frames of decoding rather than whole video.
+    Seeking assumes constant frame rate unless `exact_seek` is set, see
+    `_VideoStream`. Cached index is rebuilt if any video is modified.
+    """
+
+    def __init__(self,
+                 filepaths,
+                 clip_len=16,
+                 stride=None,
+                 labels=None,
+                 transform=None,
+                 index_path=None,
+                 exact_seek=False):
+        """Init VideoClipDataset dataset.
+
+        Args:
+            filepaths (list): paths to video files.
+            clip_len (int, optional): number of frames in each clip.
+            stride (int, optional): frames between starts of adjacent clips,
+                defaults to `clip_len`.
+            labels (list, optional): label of each video, defaults to index
+                of video.
+            transform (callable, optional): transform applied to clips.
+            index_path (str, optional): path to cache global index.
+            exact_seek (bool, optional): whether to seek by frame number,
+                set it for variable frame rate videos.
+        """
+        super(VideoClipDataset, self).__init__()
+        self.filepaths = list(filepaths)
+        self.clip_len = clip_len
+        self.stride = clip_len if stride is None else stride
+        self.labels = labels
+        self.transform = transform
+        self.index_path = index_path
+        self.exact_seek = exact_seek
+        self.num_frames = None
+        self.fps = None
+        self.offsets = None
+        self._stream = None
+        self.build_index()
+
+    def __getitem__(self, index):
+        """Get clip (T x H x W x C) and label of video."""
+        video_idx, start = self.locate(index)
+        clip = self.read_clip(video_idx, start)
+        if self.transform is not None:
+            clip = self.transform(clip)
+        if self.labels is None:
+            label = video_idx
+        else:
+            label = self.labels[video_idx]
+        return clip, label
+
+    def __len__(self):
+        """Get number of clips."""
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        """Drop decoder, which can't be shared between workers."""
+        state = self.__dict__.copy()
+        state["_stream"] = None
+        return state
+
+    def build_index(self):
+        """Build global index, or load it from cache."""
+        self.num_frames = None
+        # (mtime, size) of videos to invalidate cached index
+        stats = np.zeros((len(self.filepaths), 2), dtype=np.int64)
+        for idx, filepath in enumerate(self.filepaths):
+            if not os.path.exists(filepath):
+                raise IOError("video file doesn't exist: {}".format(filepath))
+            stat = os.stat(filepath)
+            stats[idx] = stat.st_mtime_ns, stat.st_size
+        if self.index_path is not None and os.path.exists(self.index_path):
+            index = np.load(self.index_path)
+            if list(index["filepaths"]) == self.filepaths and \
+                    "stats" in index.files and \
+                    np.array_equal(index["stats"], stats):
+                self.num_frames = index["num_frames"]
+                self.fps = index["fps"]
+        if self.num_frames is None:
+            self.num_frames = np.zeros(len(self.filepaths), dtype=np.int64)
+            self.fps = np.zeros(len(self.filepaths), dtype=np.float64)
+            for idx, filepath in enumerate(self.filepaths):
+                num_frames, _, _, _, fps = probe_video(filepath)
+                self.num_frames[idx] = num_frames
+                self.fps[idx] = fps
+            if self.index_path is not None:
+                with open(self.index_path, "wb") as f:
+                    np.savez(
+                        f,
+                        filepaths=np.array(self.filepaths),
+                        stats=stats,
+                        num_frames=self.num_frames,
+                        fps=self.fps)
+        # offsets[i] is the global index of first clip in i-th video
+        num_clips = np.maximum(
+            (self.num_frames - self.clip_len) // self.stride + 1, 0)
+        self.offsets = np.zeros(len(self.filepaths) + 1, dtype=np.int64)
+        np.cumsum(num_clips, out=self.offsets[1:])
+
+    def locate(self, index):
+        """Map global clip index to (video index, start frame)."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("clip index out of range: {}".format(index))
+        video_idx = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        start = int(index - self.offsets[video_idx]) * self.stride
+        return video_idx, start
+
+    def read_clip(self, video_idx, start):
+        """Decode frames of clip by seeking in video."""
+        filepath = self.filepaths[video_idx]
+        if self._stream is None or self._stream.filepath != filepath:
+            if self._stream is not None:
+                self._stream.close()
+            self._stream = _VideoStream(filepath, float(self.fps[video_idx]),
+                                        self.exact_seek)
+        clip = self._stream.read(start, self.clip_len)
+        if len(clip) < self.clip_len:
+            # frame count in header may be overestimated, pad last frame
+            pad = np.repeat(clip[-1:], self.clip_len - len(clip), axis=0)
+            clip = np.concatenate([clip, pad])
+        return clip
+
+
+class CachedTransformDataset(data.Dataset):
+    """Dataset caching output of deterministic transforms across epochs.
+
+    Transform chain is split into a deterministic `prefix` (e.g. decode and
+    resize to load size) and a random `suffix` (e.g. random crop, flip and
+    normalization). Output of prefix must be uint8 images of fixed shape
+    (numpy array, Tensor or PIL image), which are materialized into a
+    memory-mapped store on first access, so that later epochs and other
+    workers only run the cheap suffix. The wrapped dataset should return
+    (image, label) without its own transform.
+
+    Samples are indexed by their index in original dataset, so train/val
+    `SliceDataset` of one dataset (e.g. from `split_dataset`) can share the
+    same store. Store is rebuilt unless it was created for the same
+    dataset (image paths of `dataset.imgs` and mtimes of their folders, or
+    type and length otherwise) and the same `repr(prefix)`, so prefix
+    transforms should have a repr showing their parameters (like
+    torchvision ones). Folder mtimes only change when files are added,
+    removed or renamed, set `stat_files` to also check sizes and mtimes of
+    all images, which is slow for large datasets on network filesystems.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to be wrapped.
+        prefix (callable): deterministic transform to be cached.
+        suffix (callable, optional): transform applied after cache.
+        cache_path (str): path prefix of store files.
+        stat_files (bool, optional): whether to fingerprint every image.
+    """
+
+    def __init__(self,
+                 dataset,
+                 prefix,
+                 suffix=None,
+                 cache_path=None,
+                 stat_files=False):
+        """Init CachedTransformDataset."""
+        super(CachedTransformDataset, self).__init__()
+        if cache_path is None:
+            raise ValueError("cache_path of transform cache must be given")
+        self.dataset = dataset
+        self.prefix = prefix
+        self.suffix = suffix
+        self.cache_path = cache_path
+        self.stat_files = stat_files
+        if isinstance(dataset, SliceDataset):
+            self.excerpt = dataset.excerpt
+            source = dataset.dataset
+        else:
+            self.excerpt = None
+            source = dataset
+        self._store = None
+        self._init_store(len(source), self._fingerprint(source))
+
+    def __getitem__(self, index):
+        """Get image and target for data loader."""
+        store_idx = index if self.excerpt is None else self.excerpt[index]
+        images, labels, filled = self._get_store()
+        if filled[store_idx]:
+            image = np.array(images[store_idx])
+            label = int(labels[store_idx])
+        else:
+            image, label = self.dataset[index]
+            image = self._to_array(self.prefix(image))
+            images[store_idx] = image
+            labels[store_idx] = label
+            filled[store_idx] = 1
+        if self.kind == "pil":
+            from PIL import Image
+            image = Image.fromarray(image)
+        elif self.kind == "tensor":
+            image = torch.from_numpy(image)
+        if self.suffix is not None:
+            image = self.suffix(image)
+        return image, label
+
+    def __len__(self):
+        """Return size of dataset."""
+        return len(self.dataset)
+
+    def __getstate__(self):
+        """Drop memory maps, which are re-opened in workers."""
+        state = self.__dict__.copy()
+        state["_store"] = None
+        return state
+
+    def _fingerprint(self, source):
+        """Get hash identifying source dataset and prefix transform."""
+        sha1 = hashlib.sha1()
+        imgs = getattr(source, "imgs", None)
+        if imgs is not None:
+            folders = set()
+            for path, _ in imgs:
+                key = "{}\n".format(path)
+                if self.stat_files:
+                    key = "{}:{}".format(path, self._stat(path))
+                folders.add(os.path.dirname(path))
+                sha1.update(key.encode("utf-8"))
+            for folder in sorted(folders):
+                key = "{}:{}".format(folder, self._stat(folder))
+                sha1.update(key.encode("utf-8"))
+        else:
+            sha1.update("{}:{}\n".format(type(source).__name__,
+                                         len(source)).encode("utf-8"))
+        # drop memory addresses in default reprs, which change every run
+        prefix = re.sub(r" at 0x[0-9a-fA-F]+", "", repr(self.prefix))
+        sha1.update(prefix.encode("utf-8"))
+        return sha1.hexdigest()
+
+    @staticmethod
+    def _stat(path):
+        """Get size and mtime of path as a fingerprint line."""
+        try:
+            stat = os.stat(path or ".")
+            return "{}:{}\n".format(stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return "\n"
+
+    def _init_store(self, num_samples, fingerprint):
+        """Create store files, or reuse them if meta info matches.
+
+        Shape and kind of images are read from meta info of a matching
+        store, otherwise from the first sample.
+        """
+        meta_path = self.cache_path + ".json"
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("num_samples") == num_samples and \
+                    meta.get("fingerprint") == fingerprint:
+                self.kind = meta["kind"]
+                self.shape = tuple(meta["shape"])
+                return
+        if len(self.dataset) == 0:
+            # nothing to be cached
+            self.kind = None
+            self.shape = None
+            return
+        image, _ = self.dataset[0]
+        image = self.prefix(image)
+        if torch.is_tensor(image):
+            self.kind = "tensor"
+        elif isinstance(image, np.ndarray):
+            self.kind = "numpy"
+        else:
+            self.kind = "pil"
+        self.shape = self._to_array(image).shape
+        meta = {
+            "num_samples": num_samples,
+            "shape": list(self.shape),
+            "kind": self.kind,
+            "fingerprint": fingerprint
+        }
+        dirname = os.path.dirname(self.cache_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for suffix, nbytes in (
+            (".data", num_samples * int(np.prod(self.shape))),
+            (".labels", num_samples * 8),
+            (".mask", num_samples)):
+            # sparse files filled with zeros
+            with open(self.cache_path + suffix, "wb") as f:
+                f.truncate(nbytes)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    def _get_store(self):
+        """Get memory maps of images, labels and filled flags."""
+        if self._store is None:
+            num_samples = os.path.getsize(self.cache_path + ".mask")
+            self._store = (
+                np.memmap(self.cache_path + ".data", dtype=np.uint8,
+                          mode="r+", shape=(num_samples,) + self.shape),
+                np.memmap(self.cache_path + ".labels", dtype=np.int64,
+                          mode="r+", shape=(num_samples,)),
+                np.memmap(self.cache_path + ".mask", dtype=np.uint8,
+                          mode="r+", shape=(num_samples,)))
+        return self._store
+
+    def _to_array(self, image):
+        """Convert output of prefix transform into uint8 numpy array."""
+        if torch.is_tensor(image):
+            image = image.cpu().numpy()
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            raise ValueError("prefix transform must output uint8 images")
+        if tuple(image.shape) != getattr(self, "shape", image.shape):
+            raise ValueError("prefix transform must output images of "
+                             "fixed shape {}".format(self.shape))
+        return image
@@ -0,0 +1,285 @@
+"""Iterators over data loader."""
+
+import itertools
+import queue
+import threading
+import warnings
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def _apply_to_tensors(batch, func):
+    """Apply function to all tensors in (nested) batch."""
+    if torch.is_tensor(batch):
+        return func(batch)
+    elif isinstance(batch, dict):
+        return {k: _apply_to_tensors(v, func) for k, v in batch.items()}
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_apply_to_tensors(v, func) for v in batch)
+    return batch
+
+
+class InfIterator(object):
+    """Infinite iterator over data loader whose position can be saved.
+
+    Number of epochs and batches consumed in current epoch are tracked,
+    and `set_epoch()` of sampler is called at the beginning of every epoch.
+    With a sampler supporting mid-epoch start (e.g. ResumableRandomSampler)
+    iteration is restored from the exact next batch without loading the
+    skipped ones. Otherwise indices of skipped batches are dropped from the
+    batch sampler by a temporary loader used for the restored epoch, or,
+    without batch sampler (e.g. iterable datasets), skipped batches are
+    loaded and dropped. torch RNG state at the beginning of epoch is saved as well, so that the
+    shuffling of default RandomSampler is restored too.
+
+    ValueError is raised if a fresh epoch yields no batches, e.g. from an
+    empty dataset or a dataset smaller than batch size with `drop_last`.
+
+    Args:
+        data_loader (torch.utils.data.DataLoader): data loader to iterate.
+    """
+
+    def __init__(self, data_loader):
+        """Init iterator."""
+        super(InfIterator, self).__init__()
+        self.data_loader = data_loader
+        self.epoch = 0
+        self.cursor = 0
+        self._iterator = None
+        self._skip = 0
+        self._rng_state = None
+        self._restored_rng_state = None
+        self._restored_loader = None
+        self._fresh_epoch = False
+
+    def __iter__(self):
+        """Get iterator."""
+        return self
+
+    def __next__(self):
+        """Get next batch."""
+        while True:
+            global_rng_state = None
+            if self._iterator is None:
+                sampler = self.data_loader.sampler
+                if hasattr(sampler, "set_epoch"):
+                    sampler.set_epoch(self.epoch)
+                if self._restored_rng_state is not None:
+                    # shuffle restored epoch without touching global RNG,
+                    # sampler draws its seed at the first batch
+                    global_rng_state = torch.get_rng_state()
+                    torch.set_rng_state(self._restored_rng_state)
+                    self._restored_rng_state = None
+                self._rng_state = torch.get_rng_state()
+                data_loader = self._restored_loader or self.data_loader
+                self._restored_loader = None
+                self._iterator = iter(data_loader)
+                # restored epoch may have no batches left
+                self._fresh_epoch = self.cursor == 0 and self._skip == 0
+            try:
+                batch = next(self._iterator)
+            except StopIteration:
+                if self._fresh_epoch:
+                    raise ValueError("data loader yields no batches")
+                self._iterator = None
+                self.epoch += 1
+                self.cursor = 0
+                continue
+            finally:
+                if global_rng_state is not None:
+                    torch.set_rng_state(global_rng_state)
+            self._fresh_epoch = False
+            if self._skip > 0:
+                self._skip -= 1
+                continue
+            self.cursor += 1
+            return batch
+
+    def state_dict(self):
+        """Get state of iterator, including torch RNG state."""
+        rng_state = self._rng_state
+        if rng_state is None:
+            rng_state = torch.get_rng_state()
+        return {
+            "epoch": self.epoch,
+            "cursor": self.cursor,
+            "rng_state": rng_state
+        }
+
+    def load_state_dict(self, state_dict):
+        """Load state of iterator, next batch follows the saved position."""
+        self.epoch = state_dict["epoch"]
+        self.cursor = state_dict["cursor"]
+        self._rng_state = state_dict["rng_state"]
+        # applied when iterator of restored epoch is created
+        self._restored_rng_state = self._rng_state
+        self._iterator = None
+        self._skip = 0
+        self._restored_loader = None
+        if self.cursor == 0:
+            return
+        data_loader = self.data_loader
+        sampler = data_loader.sampler
+        if hasattr(sampler, "start") and data_loader.batch_size is not None:
+            sampler.start = self.cursor * data_loader.batch_size
+        elif data_loader.batch_sampler is not None:
+            self._restored_loader = _get_skip_loader(data_loader,
+                                                     self.cursor)
+        else:
+            warnings.warn("{} batches are loaded and dropped to restore "
+                          "iterator".format(self.cursor))
+            self._skip = self.cursor
+
+
+class _SkipBatchSampler(object):
+    """Batch sampler skipping first batches of wrapped batch sampler."""
+
+    def __init__(self, batch_sampler, skip):
+        """Init batch sampler."""
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __iter__(self):
+        """Iterate batches after skipped ones."""
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        """Return number of batches left."""
+        return max(len(self.batch_sampler) - self.skip, 0)
+
+
+def _get_skip_loader(data_loader, skip):
+    """Get loader for one epoch skipping first batches without loading."""
+    kwargs = {}
+    if data_loader.num_workers > 0:
+        kwargs["prefetch_factor"] = data_loader.prefetch_factor
+    return DataLoader(
+        data_loader.dataset,
+        batch_sampler=_SkipBatchSampler(data_loader.batch_sampler, skip),
+        num_workers=data_loader.num_workers,
+        collate_fn=data_loader.collate_fn,
+        pin_memory=data_loader.pin_memory,
+        timeout=data_loader.timeout,
+        worker_init_fn=data_loader.worker_init_fn,
+        multiprocessing_context=data_loader.multiprocessing_context,
+        generator=data_loader.generator,
+        **kwargs)
+
+
+class PrefetchIterator(object):
+    """Infinite iterator which prefetches batches in background thread.
+
+    Batches are fetched from data loader by a background thread into a
+    queue of `queue_depth` batches, epoch after epoch, so that the training
+    loop doesn't wait for workers to restart at epoch boundaries (create
+    data loader with `persistent_workers=True` to keep workers alive).
+    Batches can be copied into pinned memory and to target device
+    asynchronously on a side CUDA stream before they are consumed.
+    ValueError is raised if an epoch yields no batches.
+
+    Args:
+        data_loader (torch.utils.data.DataLoader): data loader to iterate.
+        queue_depth (int, optional): max number of prefetched batches.
+        device (torch.device or str, optional): device to copy batches to.
+        pin_memory (bool, optional): whether to copy batches into pinned
+            memory, defaults to True if device is CUDA.
+    """
+
+    def __init__(self, data_loader, queue_depth=2, device=None,
+                 pin_memory=None):
+        """Init iterator and start prefetching thread."""
+        super(PrefetchIterator, self).__init__()
+        self.data_loader = data_loader
+        self.queue_depth = queue_depth
+        self.device = None if device is None else torch.device(device)
+        use_cuda = self.device is not None and self.device.type == "cuda"
+        if pin_memory is None:
+            pin_memory = use_cuda
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._stream = torch.cuda.Stream(self.device) if use_cuda else None
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        """Get iterator."""
+        return self
+
+    def __next__(self):
+        """Get next batch."""
+        if self._thread is None:
+            raise StopIteration
+        item, event = self._queue.get()
+        if isinstance(item, _ExceptionWrapper):
+            self.close()
+            raise item.exc
+        if event is not None:
+            # wait for copy on side stream to finish
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            _apply_to_tensors(item,
+                              lambda t: t.record_stream(current_stream))
+        return item
+
+    def close(self):
+        """Stop prefetching thread."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        # unblock prefetching thread waiting on full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread = None
+
+    def _prefetch(self):
+        """Fetch batches infinitely in background thread."""
+        try:
+            while not self._stop.is_set():
+                empty = True
+                for batch in self.data_loader:
+                    empty = False
+                    if not self._put(self._stage(batch)):
+                        return
+                if empty:
+                    raise ValueError("data loader yields no batches")
+        except Exception as e:
+            self._put((_ExceptionWrapper(e), None))
+
+    def _stage(self, batch):
+        """Copy batch into pinned memory and to target device."""
+        if self.pin_memory:
+            batch = _apply_to_tensors(
+                batch, lambda t: t if t.is_pinned() else t.pin_memory())
+        if self.device is None:
+            return batch, None
+        if self._stream is None:
+            return _apply_to_tensors(batch, lambda t: t.to(self.device)), None
+        with torch.cuda.stream(self._stream):
+            batch = _apply_to_tensors(
+                batch, lambda t: t.to(self.device, non_blocking=True))
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return batch, event
+
+    def _put(self, item):
+        """Put item into queue unless iterator is stopped."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class _ExceptionWrapper(object):
+    """Wrap exception raised in prefetching thread."""
+
+    def __init__(self, exc):
+        """Init wrapper."""
+        self.exc = exc
@@ -0,0 +1,304 @@
+"""Image loaders for ImageFolder-like datasets."""
+
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no locking on non-POSIX platforms
+    fcntl = None
+
+
+def _get_default_cache_dir():
+    """Get default cache folder, in shared memory if possible."""
+    root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(root, "torchsharp-image-cache")
+
+
+class CachedLoader(object):
+    """Loader which caches decoded images shared by all workers.
+
+    Decoded (and optionally resized) images are stored as `.npy` files in
+    `cache_dir`, which defaults to a folder in shared memory (`/dev/shm`),
+    so that all DataLoader workers and later epochs read images from memory
+    instead of decoding them again. Least recently used images are evicted
+    when the cache exceeds `capacity` bytes. Total bytes of cache are kept
+    in a size file locked by all processes sharing the cache folder, so
+    that capacity is enforced across workers and loader instances. Without
+    `fcntl` (non-POSIX platforms) the size file is not locked, and
+    capacity is only enforced approximately.
+
+    Modification times of images are read once per process, so images
+    changed during training are not reloaded.
+
+    Hits and misses are counted per process, i.e. per DataLoader worker.
+
+    Args:
+        loader (callable): image loader to be wrapped, e.g. `cv2_loader`.
+        cache_dir (str, optional): folder to store decoded images.
+        capacity (int, optional): max bytes of cached images.
+        size (tuple, optional): (height, width) to resize images to before
+            caching.
+        to_pil (bool, optional): whether to return PIL images, set it if
+            wrapped loader returns PIL images (like ImageFolder's default).
+    """
+
+    def __init__(self,
+                 loader,
+                 cache_dir=None,
+                 capacity=4 * 1024**3,
+                 size=None,
+                 to_pil=False):
+        """Init loader."""
+        super(CachedLoader, self).__init__()
+        self.loader = loader
+        self.cache_dir = cache_dir or _get_default_cache_dir()
+        self.capacity = capacity
+        self.size = None if size is None else tuple(size)
+        self.to_pil = to_pil
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._mtimes = {}
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __call__(self, path):
+        """Load image from cache, or decode and cache it."""
+        cache_path = self._get_cache_path(path)
+        try:
+            img = np.load(cache_path)
+            # refresh mtime which is used as LRU order
+            os.utime(cache_path)
+            self.hits += 1
+        except (IOError, ValueError):
+            img = self._load(path)
+            self.misses += 1
+            self._save(cache_path, img)
+        if self.to_pil:
+            from PIL import Image
+            img = Image.fromarray(img)
+        return img
+
+    def stats(self):
+        """Get hits, misses and evictions counted in current process."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0.
+        }
+
+    def clear(self):
+        """Remove all cached images."""
+        with self._lock_size() as size_file:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".npy"):
+                    self._remove(entry.path)
+            self._write_size(size_file, 0)
+
+    def _get_cache_path(self, path):
+        """Get cache path keyed by image path, mtime and resized size."""
+        path = os.path.abspath(path)
+        mtime = self._mtimes.get(path)
+        if mtime is None:
+            mtime = self._mtimes[path] = os.stat(path).st_mtime_ns
+        key = "{}:{}:{}".format(path, mtime, self.size)
+        filename = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, filename + ".npy")
+
+    def _load(self, path):
+        """Decode image by wrapped loader and resize it."""
+        img = self.loader(path)
+        if self.size is not None:
+            if isinstance(img, np.ndarray):
+                import cv2
+                img = cv2.resize(
+                    img, (self.size[1], self.size[0]),
+                    interpolation=cv2.INTER_AREA)
+            else:
+                img = img.resize((self.size[1], self.size[0]))
+        return np.ascontiguousarray(img)
+
+    def _save(self, cache_path, img):
+        """Save image atomically after evicting images to make room."""
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, img)
+        nbytes = os.path.getsize(tmp_path)
+        if nbytes > self.capacity:
+            self._remove(tmp_path)
+            return
+        with self._lock_size() as size_file:
+            cache_bytes = self._read_size(size_file)
+            if cache_bytes + nbytes > self.capacity:
+                cache_bytes = self._evict(self.capacity - nbytes)
+            self._write_size(size_file, cache_bytes + nbytes)
+            os.replace(tmp_path, cache_path)
+
+    @contextlib.contextmanager
+    def _lock_size(self):
+        """Lock size file of cache shared by all processes."""
+        with open(os.path.join(self.cache_dir, "cache.size"), "a+") as f:
+            if fcntl is None:
+                yield f
+                return
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_size(self, size_file):
+        """Read total bytes of cache, which is scanned if unknown."""
+        size_file.seek(0)
+        try:
+            return int(size_file.read())
+        except ValueError:
+            return self._scan()[0]
+
+    def _write_size(self, size_file, cache_bytes):
+        """Write total bytes of cache."""
+        size_file.seek(0)
+        size_file.truncate()
+        size_file.write(str(cache_bytes))
+        size_file.flush()
+
+    def _scan(self):
+        """Get total bytes and entries (mtime, size, path) of cache."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return sum(entry[1] for entry in entries), entries
+
+    def _evict(self, limit):
+        """Evict least recently used images until 90% of limit.
+
+        Cache size is re-scanned to correct the counted size, e.g. images
+        written twice by racing workers. Size file must be locked.
+
+        Returns:
+            int: total bytes of cache after eviction.
+        """
+        cache_bytes, entries = self._scan()
+        entries.sort()
+        for _, size, path in entries:
+            if cache_bytes <= 0.9 * limit:
+                break
+            if self._remove(path):
+                self.evictions += 1
+            cache_bytes -= size
+        return cache_bytes
+
+    def _remove(self, path):
+        """Remove cached image which may be removed by others already."""
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class ReducedLoader(object):
+    """cv2 image loader which decodes images at reduced resolution.
+
+    JPEG images can be decoded at 1/2, 1/4 or 1/8 scale by DCT scaling for
+    a fraction of the cost of full decoding. The largest reduction keeping
+    the image not smaller than `load_size` is chosen by reading size from
+    image header, then decoded image is resized to `load_size`.
+
+    Decoding time saved per sample is estimated by also decoding the first
+    `num_benchmark` images at full resolution, see `stats()`.
+
+    Args:
+        load_size (tuple): (height, width) of loaded images.
+        resize (bool, optional): whether to resize images to `load_size`.
+        num_benchmark (int, optional): number of images to benchmark.
+    """
+
+    _reduced_flags = {
+        2: "IMREAD_REDUCED_COLOR_2",
+        4: "IMREAD_REDUCED_COLOR_4",
+        8: "IMREAD_REDUCED_COLOR_8"
+    }
+
+    def __init__(self, load_size, resize=True, num_benchmark=16):
+        """Init loader."""
+        super(ReducedLoader, self).__init__()
+        self.load_size = tuple(load_size)
+        self.resize = resize
+        self.num_benchmark = num_benchmark
+        self.num_samples = 0
+        self.decode_time = 0.
+        self._benchmark_full = 0.
+        self._benchmark_reduced = 0.
+        self._num_benchmarked = 0
+
+    def __call__(self, path):
+        """Load image (H x W x C) at reduced resolution."""
+        import cv2
+        scale = self.get_scale(path)
+        start = time.time()
+        if scale > 1:
+            img = cv2.imread(path, getattr(cv2, self._reduced_flags[scale]))
+        else:
+            img = cv2.imread(path)
+        elapsed = time.time() - start
+        self.num_samples += 1
+        self.decode_time += elapsed
+        if self._num_benchmarked < self.num_benchmark:
+            start = time.time()
+            cv2.imread(path)
+            self._benchmark_full += time.time() - start
+            self._benchmark_reduced += elapsed
+            self._num_benchmarked += 1
+        if self.resize and img is not None:
+            img = cv2.resize(
+                img, (self.load_size[1], self.load_size[0]),
+                interpolation=cv2.INTER_AREA)
+        return img
+
+    def get_scale(self, path):
+        """Get largest reduction which keeps image not smaller than load size.
+
+        Only size in image header is read, image is not decoded.
+        """
+        from PIL import Image
+        with Image.open(path) as img:
+            width, height = img.size
+        for scale in (8, 4, 2):
+            if (height // scale >= self.load_size[0] and
+                    width // scale >= self.load_size[1]):
+                return scale
+        return 1
+
+    def stats(self):
+        """Get decoding time and estimated time saved per sample (secs)."""
+        saved = 0.
+        if self._num_benchmarked > 0:
+            saved = (self._benchmark_full -
+                     self._benchmark_reduced) / self._num_benchmarked
+        return {
+            "samples": self.num_samples,
+            "decode_time_per_sample":
+            self.decode_time / max(self.num_samples, 1),
+            "saved_time_per_sample": saved
+        }
+
+
+def get_reduced_loader(cfg, num_benchmark=16):
+    """Get loader decoding images at reduced resolution of `cfg.load_size`."""
+    return ReducedLoader(cfg.load_size, num_benchmark=num_benchmark)
@@ -0,0 +1,249 @@
+"""Packed record format for datasets of many small files."""
+
+import json
+import mmap
+import numbers
+import os
+import pickle
+
+import numpy as np
+import torch.utils.data as data
+
+from ._utils import get_labels
+
+
+def pack_dataset(dataset,
+                 output_dir,
+                 indices=None,
+                 shard_size=1024**3,
+                 prefix="shard"):
+    """Pack dataset into a few large shard files with offset index.
+
+    For ImageFolder-like datasets (with `imgs`), raw bytes of image files
+    are packed and decoded when reading. Samples of other datasets are
+    packed as pickled `dataset[index]`.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to be packed, e.g.
+            ImageFolder or SliceDataset.
+        output_dir (str): folder to save shards and index.
+        indices (array_like, optional): indices of samples to be packed,
+            e.g. a subset from `split_dataset`, defaults to all samples.
+        shard_size (int, optional): max bytes of each shard.
+        prefix (str, optional): prefix of shard filenames.
+    """
+    if indices is None:
+        indices = np.arange(len(dataset))
+    indices = np.asarray(indices, dtype=np.int64)
+    raw = hasattr(dataset, "imgs")
+    if raw:
+        imgs = dataset.imgs
+        labels = get_labels(imgs)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    shard_ids = np.zeros(len(indices), dtype=np.int32)
+    offsets = np.zeros(len(indices), dtype=np.int64)
+    lengths = np.zeros(len(indices), dtype=np.int64)
+    targets = np.full(len(indices), -1, dtype=np.int64)
+    shard_names = []
+    f = None
+    for idx, index in enumerate(indices):
+        if raw:
+            with open(imgs[index][0], "rb") as img_file:
+                record = img_file.read()
+            targets[idx] = labels[index]
+        else:
+            sample = dataset[int(index)]
+            record = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+            if isinstance(sample, (tuple, list)) and \
+                    isinstance(sample[-1], numbers.Integral):
+                targets[idx] = sample[-1]
+        # start new shard if current one is full
+        if f is None or (f.tell() > 0 and
+                         f.tell() + len(record) > shard_size):
+            if f is not None:
+                f.close()
+            shard_names.append("{}-{:05d}.bin".format(
+                prefix, len(shard_names)))
+            f = open(os.path.join(output_dir, shard_names[-1]), "wb")
+        shard_ids[idx] = len(shard_names) - 1
+        offsets[idx] = f.tell()
+        lengths[idx] = len(record)
+        f.write(record)
+    if f is not None:
+        f.close()
+
+    with open(os.path.join(output_dir, "index.npz"), "wb") as index_file:
+        np.savez(
+            index_file,
+            indices=indices,
+            shard_ids=shard_ids,
+            offsets=offsets,
+            lengths=lengths,
+            targets=targets)
+    # meta file is written last and marks records as complete
+    meta = {
+        "raw": raw,
+        "shards": shard_names,
+        "classes": getattr(dataset, "classes", None)
+    }
+    with open(os.path.join(output_dir, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+    print("pack {} samples into {} shards in {}".format(
+        len(indices), len(shard_names), output_dir))
+
+
+def _decode_image(buffer):
+    """Decode image bytes by cv2, like `cv2_loader`."""
+    import cv2
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+class RecordDataset(data.Dataset):
+    """Dataset reading records packed by `pack_dataset`.
+
+    Shards are memory-mapped, so records are read with random access by
+    offset index without opening any file or copying bytes.
+
+    Args:
+        root (str): folder of shards and index.
+        decoder (callable, optional): function decoding raw image records
+            from uint8 numpy buffer, defaults to cv2 decoding.
+        transform (callable, optional): transform applied to images.
+        target_transform (callable, optional): transform applied to labels.
+    """
+
+    def __init__(self,
+                 root,
+                 decoder=None,
+                 transform=None,
+                 target_transform=None):
+        """Init RecordDataset."""
+        super(RecordDataset, self).__init__()
+        self.root = root
+        self.decoder = decoder or _decode_image
+        self.transform = transform
+        self.target_transform = target_transform
+        meta_path = os.path.join(root, "meta.json")
+        if not os.path.exists(meta_path):
+            raise IOError("records don't exist in {}".format(root))
+        with open(meta_path) as f:
+            meta = json.load(f)
+        self.raw = meta["raw"]
+        self.shards = meta["shards"]
+        self.classes = meta["classes"]
+        index = np.load(os.path.join(root, "index.npz"))
+        self.shard_ids = index["shard_ids"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.targets = index["targets"]
+        self._buffers = None
+
+    def __getitem__(self, index):
+        """Get image and target for data loader."""
+        shard = self._get_shard(int(self.shard_ids[index]))
+        buffer = np.frombuffer(
+            shard,
+            dtype=np.uint8,
+            count=int(self.lengths[index]),
+            offset=int(self.offsets[index]))
+        if self.raw:
+            image = self.decoder(buffer)
+            label = int(self.targets[index])
+        else:
+            sample = pickle.loads(buffer)
+            if not (isinstance(sample, (tuple, list)) and len(sample) == 2):
+                return sample
+            image, label = sample
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            label = self.target_transform(label)
+        return image, label
+
+    def __len__(self):
+        """Return size of dataset."""
+        return len(self.offsets)
+
+    def __getstate__(self):
+        """Drop memory maps, which are re-opened in workers."""
+        state = self.__dict__.copy()
+        state["_buffers"] = None
+        return state
+
+    def get_shard_indices(self, shard_id):
+        """Get indices of records in shard, in the order of offsets."""
+        return np.flatnonzero(self.shard_ids == shard_id)
+
+    def _get_shard(self, shard_id):
+        """Get memory map of shard, opening it on first use."""
+        if self._buffers is None:
+            self._buffers = [None] * len(self.shards)
+        if self._buffers[shard_id] is None:
+            path = os.path.join(self.root, self.shards[shard_id])
+            with open(path, "rb") as f:
+                self._buffers[shard_id] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._buffers[shard_id]
+
+
+class RecordStream(data.IterableDataset):
+    """Stream records shard by shard through a shuffle buffer.
+
+    Shards are read sequentially, which suits storage with slow random
+    access, and samples are shuffled within a buffer of `buffer_size`.
+    Shards are split among DataLoader workers. Call `set_epoch()` to
+    shuffle shards differently in each epoch.
+
+    Args:
+        records (RecordDataset): records to stream.
+        buffer_size (int, optional): size of shuffle buffer, no shuffling
+            if it's not larger than 1.
+        shuffle_shards (bool, optional): whether to shuffle order of shards.
+        seed (int, optional): random seed of shuffling.
+    """
+
+    def __init__(self, records, buffer_size=1024, shuffle_shards=True,
+                 seed=0):
+        """Init RecordStream."""
+        super(RecordStream, self).__init__()
+        self.records = records
+        self.buffer_size = buffer_size
+        self.shuffle_shards = shuffle_shards
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        """Iterate samples."""
+        worker_info = data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        random_state = np.random.RandomState(
+            (self.seed + self.epoch) * num_workers + worker_id)
+        shard_order = np.arange(len(self.records.shards))
+        if self.shuffle_shards:
+            np.random.RandomState(self.seed + self.epoch).shuffle(shard_order)
+
+        buffer = []
+        for shard_id in shard_order[worker_id::num_workers]:
+            for index in self.records.get_shard_indices(shard_id):
+                sample = self.records[index]
+                if len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                    continue
+                # replace random sample in full buffer
+                pos = random_state.randint(len(buffer))
+                buffer[pos], sample = sample, buffer[pos]
+                yield sample
+        random_state.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def __len__(self):
+        """Return size of dataset."""
+        return len(self.records)
+
+    def set_epoch(self, epoch):
+        """Set epoch number for shuffling."""
+        self.epoch = epoch
@@ -0,0 +1,424 @@
+"""Samplers for data loader."""
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, WeightedRandomSampler
+
+from ._utils import get_balanced_weights
+
+# max number of categories supported by torch.multinomial
+MULTINOMIAL_MAX_CATEGORIES = 1 << 24
+
+
+class InfiniteWeightedSampler(WeightedRandomSampler):
+    """WeightedRandomSampler which never stops.
+
+    Indices are drawn in blocks of `num_samples`, so that one data loader
+    can be iterated infinitely without restarting at epoch boundaries.
+    `len()` still returns the size of one block.
+    """
+
+    def __iter__(self):
+        """Iterate indices infinitely."""
+        while True:
+            for idx in super(InfiniteWeightedSampler, self).__iter__():
+                yield idx
+
+
+def get_balanced_sampler(images,
+                         num_classes,
+                         num_samples=None,
+                         replacement=True,
+                         infinite=False):
+    """Get sampler which balances classes.
+
+    Args:
+        images (list or array_like): list of (path, label) tuples like
+            `ImageFolder.imgs`, or labels of samples.
+        num_classes (int): number of classes.
+        num_samples (int, optional): number of samples per epoch, defaults
+            to the size of dataset.
+        replacement (bool, optional): whether to draw with replacement.
+        infinite (bool, optional): whether to draw samples infinitely.
+
+    Returns:
+        torch.utils.data.WeightedRandomSampler: balanced sampler.
+    """
+    weights = get_balanced_weights(images, num_classes)
+    if num_samples is None:
+        num_samples = len(weights)
+    if infinite:
+        return InfiniteWeightedSampler(weights, num_samples, replacement)
+    return WeightedRandomSampler(weights, num_samples, replacement)
+
+
+class ResumableRandomSampler(Sampler):
+    """Random sampler which can resume from the middle of an epoch.
+
+    Permutation of each epoch is generated from `seed` and epoch number,
+    so that it can be restored exactly from a saved state together with
+    the number of samples already drawn. See `InfIterator`.
+
+    Args:
+        data_source (torch.utils.data.Dataset): dataset to sample from.
+        seed (int, optional): random seed, defaults to the seed set by
+            `init_random_seed`.
+    """
+
+    def __init__(self, data_source, seed=None):
+        """Init sampler."""
+        super(ResumableRandomSampler, self).__init__()
+        self.num_samples = len(data_source)
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.epoch = 0
+        self.start = 0
+
+    def __iter__(self):
+        """Iterate indices of current epoch from `start`."""
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_samples, generator=generator)
+        start, self.start = self.start, 0
+        return iter(indices[start:].tolist())
+
+    def __len__(self):
+        """Get number of samples to draw."""
+        return self.num_samples - self.start
+
+    def set_epoch(self, epoch):
+        """Set epoch number for shuffling."""
+        self.epoch = epoch
+
+    def state_dict(self):
+        """Get state of sampler."""
+        return {"seed": self.seed, "epoch": self.epoch, "start": self.start}
+
+    def load_state_dict(self, state_dict):
+        """Load state of sampler."""
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.start = state_dict["start"]
+
+
+class LossAwareSampler(Sampler):
+    """Sampler drawing samples in proportion to their difficulty.
+
+    Latest loss (or 1 - correctness) reported for each sample is kept in
+    a compact float32 array. Every epoch draws `fraction` of dataset with
+    probabilities proportional to these scores, mixed with uniform
+    probabilities by `floor` so that easy samples are still revisited.
+    Scores start at 1, i.e. the first epoch is uniform. Optional base
+    weights (e.g. from `get_balanced_weights`) are multiplied to
+    probabilities. Wrap dataset with `IndexedDataset` to get indices of
+    samples in batch for `update()`.
+
+    Args:
+        data_source (torch.utils.data.Dataset): dataset to sample from.
+        fraction (float, optional): fraction of dataset drawn per epoch.
+        floor (float, optional): weight of uniform probabilities, every
+            sample is drawn with probability at least `floor / N`.
+        weights (sequence, optional): base weights of samples.
+        replacement (bool, optional): whether to draw with replacement.
+        momentum (float, optional): momentum of moving average of scores,
+            0 keeps only the latest reported score.
+    """
+
+    def __init__(self,
+                 data_source,
+                 fraction=1.0,
+                 floor=0.1,
+                 weights=None,
+                 replacement=True,
+                 momentum=0.):
+        """Init sampler."""
+        super(LossAwareSampler, self).__init__()
+        self.num_samples = len(data_source)
+        self.fraction = fraction
+        self.floor = floor
+        self.weights = None
+        if weights is not None:
+            self.weights = torch.as_tensor(weights, dtype=torch.float64)
+        self.replacement = replacement
+        self.momentum = momentum
+        self.scores = torch.ones(self.num_samples, dtype=torch.float32)
+
+    def __iter__(self):
+        """Iterate indices drawn by difficulty."""
+        probs = self.get_probs()
+        if len(probs) <= MULTINOMIAL_MAX_CATEGORIES:
+            indices = torch.multinomial(probs, len(self), self.replacement)
+        elif self.replacement:
+            # inverse transform sampling
+            cdf = probs.double().cumsum(0)
+            indices = torch.searchsorted(
+                cdf, torch.rand(len(self), dtype=torch.float64) * cdf[-1])
+            indices = indices.clamp(max=len(probs) - 1)
+        else:
+            # weighted sampling without replacement by exponential keys
+            keys = torch.rand(len(probs), dtype=torch.float64).log() / probs
+            indices = keys.topk(len(self))[1]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        """Get number of samples drawn per epoch."""
+        return max(1, int(np.ceil(self.fraction * self.num_samples)))
+
+    def update(self, indices, scores):
+        """Report latest losses or difficulties of samples.
+
+        Args:
+            indices (sequence): indices of samples in dataset.
+            scores (sequence): non-negative losses of samples, or
+                1 - correctness of predictions.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64).cpu()
+        scores = torch.as_tensor(scores).detach().float().cpu().view(-1)
+        if self.momentum > 0:
+            scores = (self.momentum * self.scores[indices] +
+                      (1 - self.momentum) * scores)
+        self.scores[indices] = scores.clamp(min=0)
+
+    def get_probs(self):
+        """Get probabilities of drawing every sample."""
+        scores = self.scores.double()
+        total = scores.sum()
+        if total > 0:
+            probs = (1 - self.floor) * scores / total + \
+                self.floor / self.num_samples
+        else:
+            probs = torch.full_like(scores, 1. / self.num_samples)
+        if self.weights is not None:
+            probs = probs * self.weights
+            probs /= probs.sum()
+        return probs
+
+    def get_importance(self, indices):
+        """Get importance weights of samples for unbiased loss.
+
+        Weights are `1 / (N * p)`, multiply them to per-sample losses to
+        keep expectation of loss equal to uniform sampling.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64).cpu()
+        return (1. / (self.num_samples * self.get_probs()[indices])).float()
+
+
+def _feistel_permute(positions, size, key):
+    """Permute positions in [0, size) by keyed Feistel network.
+
+    Any subset of the permutation can be computed without materializing
+    the whole permutation. Positions falling out of range after a round
+    trip through the network are walked again (cycle walking).
+    """
+    half_bits = max(1, int(np.ceil(np.log2(max(size, 2)) / 2)))
+    mask = np.uint64((1 << half_bits) - 1)
+    keys = np.random.RandomState(key).randint(
+        0, 2**31, size=4).astype(np.uint64)
+    positions = np.asarray(positions, dtype=np.uint64)
+    pending = np.ones(len(positions), dtype=bool)
+    while pending.any():
+        x = positions[pending]
+        left, right = x >> np.uint64(half_bits), x & mask
+        for round_key in keys:
+            mixed = (right * np.uint64(0x9E3779B1) + round_key) & mask
+            mixed ^= (mixed >> np.uint64(3)) ^ (mixed << np.uint64(2)) & mask
+            left, right = right, left ^ mixed
+        x = (left << np.uint64(half_bits)) | right
+        positions[pending] = x
+        pending[pending] = x >= size
+    return positions.astype(np.int64)
+
+
+class DistributedSplitSampler(Sampler):
+    """Sampler of disjoint, equal-sized shards of a split for each rank.
+
+    Each rank computes only its own shard of the epoch's permutation of
+    split (e.g. `split["train"]` from `split_dataset` or
+    `load_dataset_split`) from `seed` and epoch, without materializing the
+    whole permutation. Like DistributedSampler, indices are padded by
+    wrapping around to make shards equal-sized unless `drop_last` is set.
+    Call `set_epoch()` before every epoch.
+
+    Args:
+        indices (array_like): indices of samples in split.
+        num_replicas (int, optional): number of processes, defaults to
+            world size of current process group.
+        rank (int, optional): rank of current process, defaults to rank in
+            current process group.
+        shuffle (bool, optional): whether to shuffle indices every epoch.
+        seed (int, optional): random seed shared by all processes.
+        drop_last (bool, optional): whether to drop tail of split instead
+            of padding it.
+    """
+
+    def __init__(self,
+                 indices,
+                 num_replicas=None,
+                 rank=None,
+                 shuffle=True,
+                 seed=0,
+                 drop_last=False):
+        """Init sampler."""
+        super(DistributedSplitSampler, self).__init__()
+        if num_replicas is None or rank is None:
+            import torch.distributed as dist
+            if not dist.is_available() or not dist.is_initialized():
+                raise RuntimeError("process group should be initialized "
+                                   "if num_replicas or rank is not given")
+            num_replicas = dist.get_world_size()
+            rank = dist.get_rank()
+        if not 0 <= rank < num_replicas:
+            raise ValueError("invalid rank {} for {} replicas".format(
+                rank, num_replicas))
+        self.indices = np.asarray(indices)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        if drop_last:
+            self.num_samples = len(self.indices) // num_replicas
+        else:
+            self.num_samples = -(-len(self.indices) // num_replicas)
+
+    def __iter__(self):
+        """Iterate indices in shard of current rank."""
+        positions = np.arange(
+            self.rank, self.num_samples * self.num_replicas,
+            self.num_replicas) % len(self.indices)
+        if self.shuffle:
+            positions = _feistel_permute(positions, len(self.indices),
+                                         [self.seed, self.epoch])
+        return iter(self.indices[positions].tolist())
+
+    def __len__(self):
+        """Get number of samples in shard."""
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        """Set epoch number for shuffling."""
+        self.epoch = epoch
+
+
+def get_image_sizes(images, cache_path=None):
+    """Get sizes of images by reading only their headers.
+
+    Args:
+        images (list): list of (path, label) tuples like `ImageFolder.imgs`.
+        cache_path (str, optional): path to cache sizes as `.npy` file.
+
+    Returns:
+        numpy.ndarray: (N, 2) array of (height, width).
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        sizes = np.load(cache_path)
+        if len(sizes) == len(images):
+            return sizes
+    from PIL import Image
+    sizes = np.zeros((len(images), 2), dtype=np.int32)
+    for idx, item in enumerate(images):
+        with Image.open(item[0]) as img:
+            sizes[idx] = img.size[::-1]
+    if cache_path is not None:
+        with open(cache_path, "wb") as f:
+            np.save(f, sizes)
+    return sizes
+
+
+class AspectRatioBatchSampler(Sampler):
+    """Batch sampler grouping images of similar aspect ratio.
+
+    Samples are put into buckets by aspect ratio (width / height), and
+    every batch is drawn from a single bucket so that images in one batch
+    can be resized to a uniform shape with little distortion or padding.
+    Samples in buckets and order of batches are shuffled every epoch.
+    Shuffling is reproducible from `seed`, which defaults to the seed set
+    by `init_random_seed`. Call `set_epoch()` before every epoch.
+
+    Args:
+        sizes (array_like): (N, 2) array of (height, width) of images, see
+            `get_image_sizes`.
+        batch_size (int): size of mini-batch.
+        boundaries (sequence, optional): boundaries of aspect ratio between
+            buckets, defaults to quantiles splitting samples equally into
+            `num_buckets` buckets.
+        num_buckets (int, optional): number of buckets.
+        drop_last (bool, optional): whether to drop the last incomplete
+            batch of each bucket.
+        seed (int, optional): random seed.
+    """
+
+    def __init__(self,
+                 sizes,
+                 batch_size,
+                 boundaries=None,
+                 num_buckets=5,
+                 drop_last=False,
+                 seed=None):
+        """Init sampler."""
+        super(AspectRatioBatchSampler, self).__init__()
+        sizes = np.asarray(sizes)
+        self.aspect_ratios = sizes[:, 1] / sizes[:, 0].astype(np.float64)
+        if boundaries is None:
+            quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+            boundaries = np.unique(np.quantile(self.aspect_ratios, quantiles))
+        self.boundaries = np.asarray(boundaries, dtype=np.float64)
+        self.bucket_ids = np.searchsorted(
+            self.boundaries, self.aspect_ratios, side="right")
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.epoch = 0
+
+    def __iter__(self):
+        """Iterate batches of indices."""
+        random_state = np.random.RandomState(
+            (self.seed + self.epoch) % 2**32)
+        batches = []
+        for bucket in range(len(self.boundaries) + 1):
+            indices = np.flatnonzero(self.bucket_ids == bucket)
+            random_state.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        for idx in random_state.permutation(len(batches)):
+            yield batches[idx]
+
+    def __len__(self):
+        """Get number of batches."""
+        counts = np.bincount(
+            self.bucket_ids, minlength=len(self.boundaries) + 1)
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(((counts + self.batch_size - 1) // self.batch_size).sum())
+
+    def set_epoch(self, epoch):
+        """Set epoch number for shuffling."""
+        self.epoch = epoch
+
+    def get_bucket_shapes(self, image_size, multiple=32):
+        """Get uniform (height, width) of images in each bucket.
+
+        Shapes keep area of `image_size` with median aspect ratio of bucket,
+        rounded to `multiple`.
+
+        Args:
+            image_size (sequence): (height, width) like `cfg.image_size`.
+            multiple (int, optional): round height and width to multiple.
+
+        Returns:
+            numpy.ndarray: (num_buckets, 2) array of (height, width).
+        """
+        area = float(image_size[0] * image_size[1])
+        shapes = np.zeros((len(self.boundaries) + 1, 2))
+        for bucket in range(len(shapes)):
+            ratios = self.aspect_ratios[self.bucket_ids == bucket]
+            ratio = np.median(ratios) if len(ratios) > 0 else 1.
+            height = np.sqrt(area / ratio)
+            shapes[bucket] = (height, height * ratio)
+        shapes = np.maximum(np.round(shapes / multiple), 1) * multiple
+        return shapes.astype(np.int64)
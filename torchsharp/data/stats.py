@@ -0,0 +1,145 @@
+"""Statistics of images in dataset."""
+
+import os
+
+import torch
+import torch.utils.data as data
+
+
+def _init_stats(num_channels, bins):
+    """Init empty per-channel statistics."""
+    stats = {
+        "count": 0,
+        "mean": torch.zeros(num_channels, dtype=torch.float64),
+        "m2": torch.zeros(num_channels, dtype=torch.float64),
+        "min": torch.full((num_channels, ), float("inf"),
+                          dtype=torch.float64),
+        "max": torch.full((num_channels, ), float("-inf"),
+                          dtype=torch.float64)
+    }
+    if bins is not None:
+        stats["hist"] = torch.zeros(num_channels, bins, dtype=torch.float64)
+    return stats
+
+
+def _merge_stats(a, b):
+    """Merge two partial statistics by Chan's parallel algorithm."""
+    if a["count"] == 0:
+        return b
+    if b["count"] == 0:
+        return a
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    merged = {
+        "count": count,
+        "mean": a["mean"] + delta * b["count"] / count,
+        "m2": a["m2"] + b["m2"] + delta**2 * a["count"] * b["count"] / count,
+        "min": torch.min(a["min"], b["min"]),
+        "max": torch.max(a["max"], b["max"])
+    }
+    if "hist" in a:
+        merged["hist"] = a["hist"] + b["hist"]
+    return merged
+
+
+def _image_stats(image, bins, value_range):
+    """Get statistics of single (C, H, W) image."""
+    pixels = torch.as_tensor(image).reshape(image.shape[0], -1).double()
+    mean = pixels.mean(dim=1)
+    stats = {
+        "count": pixels.size(1),
+        "mean": mean,
+        "m2": ((pixels - mean.unsqueeze(1))**2).sum(dim=1),
+        "min": pixels.min(dim=1)[0],
+        "max": pixels.max(dim=1)[0]
+    }
+    if bins is not None:
+        stats["hist"] = torch.stack([
+            torch.histc(channel, bins, value_range[0], value_range[1])
+            for channel in pixels
+        ])
+    return stats
+
+
+class _StatsShard(data.IterableDataset):
+    """Compute partial statistics over a shard of dataset in each worker."""
+
+    def __init__(self, dataset, bins, value_range):
+        """Init shard."""
+        super(_StatsShard, self).__init__()
+        self.dataset = dataset
+        self.bins = bins
+        self.value_range = value_range
+
+    def __iter__(self):
+        """Yield partial statistics of samples in this worker."""
+        worker_info = data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        stats = None
+        for index in range(worker_id, len(self.dataset), num_workers):
+            image = self.dataset[index][0]
+            image_stats = _image_stats(image, self.bins, self.value_range)
+            if stats is None:
+                stats = image_stats
+            else:
+                stats = _merge_stats(stats, image_stats)
+        if stats is not None:
+            yield stats
+
+
+def compute_dataset_stats(dataset,
+                          num_workers=0,
+                          bins=None,
+                          value_range=(0., 1.),
+                          save_path=None):
+    """Compute per-channel statistics of images in one streaming pass.
+
+    Images are never kept in memory. Every DataLoader worker computes
+    partial statistics over its shard of samples, which are merged by
+    Chan's parallel algorithm.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset returning (C, H, W)
+            Tensor image as first item of each sample, e.g. with ToTensor.
+        num_workers (int, optional): number of workers.
+        bins (int, optional): number of histogram bins per channel, no
+            histogram is computed if not given.
+        value_range (tuple, optional): (min, max) range of histogram.
+        save_path (str, optional): path to save statistics, e.g. next to
+            saved dataset split.
+
+    Returns:
+        dict: "count", "mean", "std", "min", "max" and optional "hist".
+    """
+    loader = data.DataLoader(
+        _StatsShard(dataset, bins, value_range),
+        batch_size=None,
+        num_workers=num_workers)
+    stats = {"count": 0}
+    for partial in loader:
+        stats = _merge_stats(stats, partial)
+    if stats["count"] == 0:
+        raise ValueError("can't compute statistics of empty dataset")
+
+    stats["std"] = (stats.pop("m2") / stats["count"]).sqrt()
+    for key in ("mean", "std", "min", "max"):
+        stats[key] = stats[key].float()
+    if save_path is not None:
+        save_dataset_stats(stats, save_path)
+    return stats
+
+
+def save_dataset_stats(stats, filepath):
+    """Save statistics of dataset."""
+    dirname = os.path.dirname(filepath)
+    if not dirname or os.path.exists(dirname):
+        torch.save(stats, filepath)
+
+
+def load_dataset_stats(filepath):
+    """Load statistics of dataset."""
+    stats = None
+    if os.path.exists(filepath):
+        stats = torch.load(filepath)
+    return stats
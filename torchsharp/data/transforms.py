@@ -8,18 +8,32 @@ def _is_tensor_image(img):
     return torch.is_tensor(img) and img.ndimension() == 3
 
 
-def expand_channel(img, dim, repeat):
+def _is_tensor_batch(batch):
+    """Check if the input batch is a Tensor of 4 dimensions."""
+    return torch.is_tensor(batch) and batch.ndimension() == 4
+
+
+def expand_channel(img, dim, repeat, copy=True):
     """Expand channel of the given Tensor image.
 
     Args:
         tensor (Tensor): Tensor image of size (C, H, W) to be expanded.
         dim (int): dimension of the channel to be repeated.
         repeat (int): repeat time.
+        copy (bool, optional): whether to copy data. If not, a view without
+            allocating memory is returned when channel size is 1, which is
+            materialized only when a downstream op needs contiguous memory.
 
     Returns:
         Tensor: Tensor image with expanded channels.
     """
-    return torch.cat([img for cnt in range(repeat)], dim)
+    if not copy and img.size(dim) == 1:
+        sizes = [-1] * img.dim()
+        sizes[dim] = repeat
+        return img.expand(*sizes)
+    sizes = [1] * img.dim()
+    sizes[dim] = repeat
+    return img.repeat(*sizes)
 
 
 class ExpandChannel(object):
@@ -33,13 +47,121 @@ class ExpandChannel(object):
     Args:
         dim (int): dimension of the channel to be repeated.
         repeat (int): repeat time.
+        copy (bool, optional): whether to copy data or return a view.
     """
 
-    def __init__(self, repeat, dim=0):
+    def __init__(self, repeat, dim=0, copy=True):
         """Init transform."""
         self.repeat = repeat
         self.dim = dim
+        self.copy = copy
 
     def __call__(self, img):
         """Call transform."""
-        return expand_channel(img, self.repeat, self.dim)
+        return expand_channel(img, self.dim, self.repeat, self.copy)
+
+
+class BatchCompose(object):
+    """Compose several batch transforms together.
+
+    Batch transforms run once on the collated (N, C, H, W) Tensor batch,
+    e.g. after it's copied to GPU, instead of once per sample in workers.
+
+    Args:
+        transforms (list): list of batch transforms.
+    """
+
+    def __init__(self, transforms):
+        """Init transform."""
+        self.transforms = transforms
+
+    def __call__(self, batch):
+        """Call transform."""
+        for t in self.transforms:
+            batch = t(batch)
+        return batch
+
+
+class BatchNormalize(object):
+    """Normalize Tensor batch with mean and standard deviation.
+
+    Args:
+        mean (sequence): means for each channel.
+        std (sequence): standard deviations for each channel.
+        inplace (bool, optional): whether to normalize in place.
+    """
+
+    def __init__(self, mean, std, inplace=False):
+        """Init transform."""
+        self.mean = mean
+        self.std = std
+        self.inplace = inplace
+
+    def __call__(self, batch):
+        """Call transform."""
+        assert _is_tensor_batch(batch), "batch must be (N, C, H, W) Tensor"
+        mean = torch.as_tensor(
+            self.mean, dtype=batch.dtype, device=batch.device)
+        std = torch.as_tensor(self.std, dtype=batch.dtype, device=batch.device)
+        if not self.inplace:
+            batch = batch.clone()
+        elif not batch.is_contiguous():
+            # views like expanded channels can't be written in place
+            batch = batch.contiguous()
+        return batch.sub_(mean.view(1, -1, 1, 1)).div_(std.view(1, -1, 1, 1))
+
+
+class BatchExpandChannel(object):
+    """Expand channel of Tensor batch.
+
+    Args:
+        repeat (int): repeat time.
+        copy (bool, optional): whether to copy data or return a view.
+    """
+
+    def __init__(self, repeat, copy=False):
+        """Init transform."""
+        self.repeat = repeat
+        self.copy = copy
+
+    def __call__(self, batch):
+        """Call transform."""
+        assert _is_tensor_batch(batch), "batch must be (N, C, H, W) Tensor"
+        return expand_channel(batch, 1, self.repeat, self.copy)
+
+
+class BatchRandomFlip(object):
+    """Flip each image in Tensor batch randomly with probability p.
+
+    Args:
+        p (float, optional): probability of each image being flipped.
+        vertical (bool, optional): flip vertically instead of horizontally.
+    """
+
+    def __init__(self, p=0.5, vertical=False):
+        """Init transform."""
+        self.p = p
+        self.vertical = vertical
+
+    def __call__(self, batch):
+        """Call transform."""
+        assert _is_tensor_batch(batch), "batch must be (N, C, H, W) Tensor"
+        flipped = batch.flip(2 if self.vertical else 3)
+        mask = torch.rand(batch.size(0), device=batch.device) < self.p
+        return torch.where(mask.view(-1, 1, 1, 1), flipped, batch)
+
+
+def split_transform(transform, num_prefix):
+    """Split composed transform into prefix and suffix.
+
+    Args:
+        transform (object): composed transform with `transforms` attribute,
+            e.g. torchvision.transforms.Compose.
+        num_prefix (int): number of transforms in prefix.
+
+    Returns:
+        tuple: (prefix, suffix) transforms of the same type as `transform`.
+    """
+    transforms = list(transform.transforms)
+    return (type(transform)(transforms[:num_prefix]),
+            type(transform)(transforms[num_prefix:]))
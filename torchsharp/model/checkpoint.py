@@ -0,0 +1,348 @@
+"""Checkpoint writers for models."""
+
+import functools
+import os
+import queue
+import random
+import threading
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+
+
+def snapshot(obj, memo=None):
+    """Copy all tensors in (nested) state into CPU memory.
+
+    Tensors sharing storage (e.g. tied weights) still share the copied
+    storage, so that they are serialized only once.
+
+    Args:
+        obj (object): state to be copied, e.g. state_dict of network.
+        memo (dict, optional): copied storages keyed by data pointer.
+
+    Returns:
+        object: state with copied tensors.
+    """
+    if memo is None:
+        memo = {}
+    if torch.is_tensor(obj):
+        tensor = obj.detach()
+        storage = tensor.untyped_storage()
+        key = (storage.device, storage.data_ptr())
+        if key not in memo:
+            memo[key] = storage.cpu() if storage.device.type != "cpu" \
+                else storage.clone()
+        copied = torch.empty(0, dtype=tensor.dtype)
+        return copied.set_(memo[key], tensor.storage_offset(), tensor.size(),
+                           tensor.stride())
+    elif isinstance(obj, dict):
+        copied = type(obj)()
+        for k, v in obj.items():
+            copied[k] = snapshot(v, memo)
+        if hasattr(obj, "_metadata"):
+            copied._metadata = obj._metadata
+        return copied
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """Get states of python, numpy, torch and CUDA random generators.
+
+    States contain only tensors and python primitives, which can be loaded
+    by `torch.load(weights_only=True)`.
+    """
+    np_state = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": {
+            "name": np_state[0],
+            "keys": torch.from_numpy(np_state[1].astype(np.int64)),
+            "pos": np_state[2],
+            "has_gauss": np_state[3],
+            "cached_gaussian": np_state[4]
+        },
+        "torch": torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Set states of random generators from `get_rng_state()`."""
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]),
+                     python_state[2]))
+    np_state = state["numpy"]
+    np.random.set_state((np_state["name"],
+                         np_state["keys"].numpy().astype(np.uint32),
+                         np_state["pos"], np_state["has_gauss"],
+                         np_state["cached_gaussian"]))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_checkpoint_file(filepath, map_location=None, mmap=False):
+    """Load checkpoint file.
+
+    With mmap, tensor data stays in the page cache and is read lazily when
+    copied into parameters, so that loading a checkpoint doesn't need twice
+    its size in memory. Files in legacy (non-zip) format fall back to
+    normal loading.
+
+    Args:
+        filepath (str): Path to checkpoint.
+        map_location (str or torch.device, optional): Device to load onto.
+        mmap (bool, optional): Whether to memory-map tensor data.
+
+    Returns:
+        object: loaded checkpoint.
+    """
+    if mmap:
+        try:
+            return torch.load(filepath, map_location=map_location, mmap=True)
+        except RuntimeError:
+            pass
+    return torch.load(filepath, map_location=map_location)
+
+
+def _module_classes(cls=nn.Module):
+    """Iterate over all subclasses of module class."""
+    yield cls
+    for subclass in cls.__subclasses__():
+        yield from _module_classes(subclass)
+
+
+def _record_args(init):
+    """Wrap __init__ of module to record its constructor arguments."""
+
+    @functools.wraps(init)
+    def wrapper(self, *args, **kwargs):
+        # only arguments of the most derived class are recorded
+        if "_deferred_args" not in self.__dict__:
+            self.__dict__["_deferred_args"] = (args, kwargs)
+        init(self, *args, **kwargs)
+
+    return wrapper
+
+
+def deferred_init(builder, *args, **kwargs):
+    """Build network on meta device without allocating storage.
+
+    Constructor arguments of every submodule are recorded, so that tensors
+    which can't be restored or initialized otherwise are recomputed by
+    rebuilding only their own submodules. Don't build other modules in
+    other threads meanwhile.
+
+    Args:
+        builder (callable): Network class or function building network.
+
+    Returns:
+        torch.nn.Module: network whose parameters and buffers are on meta
+            device, to be materialized by `materialize_network()`.
+    """
+    inits = {
+        cls: cls.__dict__["__init__"]
+        for cls in set(_module_classes()) if "__init__" in cls.__dict__
+    }
+    try:
+        for cls, init in inits.items():
+            cls.__init__ = _record_args(init)
+        with torch.device("meta"):
+            return builder(*args, **kwargs)
+    finally:
+        for cls, init in inits.items():
+            cls.__init__ = init
+
+
+def _named_tensors(net):
+    """Iterate over direct parameters and buffers of all modules."""
+    for prefix, module in net.named_modules():
+        prefix = prefix + "." if prefix else ""
+        for tensors in [module._parameters, module._buffers]:
+            for name, tensor in tensors.items():
+                if tensor is not None:
+                    yield prefix + name, module, tensors, name, tensor
+
+
+def _needs_rebuild(module, tensors):
+    """Check if tensor can't be recomputed by `reset_parameters()`."""
+    if tensors is module._parameters:
+        return not hasattr(module, "reset_parameters")
+    return not isinstance(module, nn.modules.batchnorm._NormBase)
+
+
+def _rebuild_tensors(net, keys, device):
+    """Recompute tensors by rebuilding their submodules eagerly."""
+    modules = dict(net.named_modules())
+    rebuilt, references = {}, {}
+    for key in keys:
+        prefix, _, name = key.rpartition(".")
+        if prefix not in references:
+            args = modules[prefix].__dict__.get("_deferred_args")
+            if args is None:
+                raise RuntimeError(
+                    "{} is not in checkpoint and can't be recomputed, build "
+                    "network by deferred_init()".format(key))
+            with torch.device(device):
+                references[prefix] = type(modules[prefix])(*args[0],
+                                                           **args[1])
+        tensor = getattr(references[prefix], name)
+        if tensor is None or tensor.is_meta:
+            raise RuntimeError(
+                "{} is not in checkpoint and can't be recomputed".format(key))
+        rebuilt[key] = tensor.detach()
+    return rebuilt
+
+
+def materialize_network(net, state_dict, device="cpu", initializer=None):
+    """Materialize network on meta device from checkpoint.
+
+    Tensors in state_dict are assigned to network directly without copy.
+    The remaining parameters are allocated on device and initialized by
+    `reset_parameters()` of their modules and then the initializer, while
+    tensors from checkpoint are kept untouched. Running stats of norm
+    layers are reset, and other tensors missing in checkpoint (e.g.
+    buffers computed in `__init__`, or parameters of modules without
+    `reset_parameters()`) are recomputed by rebuilding only their own
+    submodules recorded by `deferred_init()`, with a warning. RuntimeError
+    is raised if they can't be recomputed.
+
+    Args:
+        net (torch.nn.Module): Network built by `deferred_init()`.
+        state_dict (dict): Network checkpoint, could be empty.
+        device (str or torch.device, optional): Device of new tensors.
+        initializer (callable, optional): Weight initializer of network.
+
+    Returns:
+        list: names of tensors not covered by checkpoint.
+    """
+    keys = [
+        key for key, module, tensors, _, tensor in _named_tensors(net)
+        if tensor.is_meta and key not in state_dict and
+        _needs_rebuild(module, tensors)
+    ]
+    rebuilt = {}
+    if len(keys) > 0:
+        warnings.warn("recompute tensors not in checkpoint by rebuilding "
+                      "their modules: {}".format(", ".join(keys)))
+        rebuilt = _rebuild_tensors(net, keys, device)
+    result = net.load_state_dict(state_dict, strict=False, assign=True)
+    covered = set(state_dict) - set(result.unexpected_keys)
+    # hide restored tensors behind meta tensors while initializing
+    loaded, uncovered, modules = [], [], []
+    for key, module, tensors, name, tensor in _named_tensors(net):
+        if key in covered and not tensor.is_meta:
+            loaded.append((tensors, name, tensor))
+            new_tensor = torch.empty_like(tensor, device="meta")
+        elif tensor.is_meta:
+            uncovered.append(key)
+            # rebuilt tensors stay on meta device until initialized
+            if key in rebuilt:
+                continue
+            if module not in modules:
+                modules.append(module)
+            new_tensor = torch.empty_like(tensor, device=device)
+        else:
+            continue
+        if isinstance(tensor, nn.Parameter):
+            new_tensor = nn.Parameter(new_tensor, tensor.requires_grad)
+        tensors[name] = new_tensor
+    if len(uncovered) > 0:
+        for module in modules:
+            if hasattr(module, "reset_parameters"):
+                module.reset_parameters()
+        if initializer is not None:
+            initializer(net)
+    for tensors, name, tensor in loaded:
+        tensors[name] = tensor
+    for key, tensor in rebuilt.items():
+        prefix, _, name = key.rpartition(".")
+        module = net.get_submodule(prefix)
+        if name in module._parameters:
+            module._parameters[name] = nn.Parameter(
+                tensor, module._parameters[name].requires_grad)
+        else:
+            module._buffers[name] = tensor
+    return uncovered
+
+
+def atomic_save(obj, filepath):
+    """Save object to a temporary file and rename it to filepath.
+
+    A crash never leaves a truncated checkpoint at filepath.
+    """
+    tmp_path = "{}.{}.tmp".format(filepath, os.getpid())
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+
+class AsyncCheckpointWriter(object):
+    """Write checkpoints on a background thread.
+
+    `save()` only snapshots state into CPU memory and returns, serializing
+    and writing happen on background thread with `atomic_save`. At most
+    `max_pending` snapshots are kept in memory, `save()` blocks if more
+    are pending. Call `wait()` to flush all pending checkpoints, e.g.
+    before shutdown. Errors in background thread are raised by the next
+    `save()` or `wait()`.
+
+    Args:
+        max_pending (int, optional): max number of pending checkpoints.
+    """
+
+    def __init__(self, max_pending=2):
+        """Init writer and start background thread."""
+        super(AsyncCheckpointWriter, self).__init__()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def save(self, obj, filepath):
+        """Snapshot object and save it in background."""
+        self._raise_error()
+        self._queue.put((snapshot(obj), filepath))
+
+    def wait(self):
+        """Wait until all pending checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush pending checkpoints and stop background thread."""
+        if self._thread is None:
+            return
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._raise_error()
+
+    def _write(self):
+        """Write checkpoints in background thread."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    atomic_save(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        """Raise error in background thread."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
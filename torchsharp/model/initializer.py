@@ -4,131 +4,243 @@ partly referenced from:
 https://github.com/junyanz/pytorch-CycleGAN-and-pix2pix/blob/master/models/networks.py
 """
 
-from functools import partial
+import math
+from collections import Counter, defaultdict
 
+import torch
 from torch import nn
 
+# max number of elements initialized in one batch
+BATCH_NUMEL = 1 << 24
 
-def init_layer_normal(layer):
-    """Init layer weights with normal distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.normal(layer.weight.data, 0.0, 0.02)
-    elif layer_name.find("Linear") != -1:
-        nn.init.normal(layer.weight.data, 0.0, 0.02)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.normal(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_uniform(layer):
-    """Init layer weights with uniform distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.uniform(layer.weight.data, 0.0, 1.0)
-    elif layer_name.find("Linear") != -1:
-        nn.init.uniform(layer.weight.data, 0.0, 1.0)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_xavier_normal(layer):
-    """Init layer weights by xavier method with normal distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.xavier_normal(layer.weight.data, gain=1)
-    elif layer_name.find("Linear") != -1:
-        nn.init.xavier_normal(layer.weight.data, gain=1)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_xavier_uniform(layer):
-    """Init layer weights by xavier method with uniform distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.xavier_uniform(layer.weight.data, gain=1)
-    elif layer_name.find("Linear") != -1:
-        nn.init.xavier_uniform(layer.weight.data, gain=1)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_kaiming_normal(layer):
-    """Init layer weights by kaiming method with normal distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.kaiming_normal(layer.weight.data, a=0, mode="fan_in")
-    elif layer_name.find("Linear") != -1:
-        nn.init.kaiming_normal(layer.weight.data, a=0, mode="fan_in")
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_kaiming_uniform(layer):
-    """Init layer weights by kaiming method with uniform distribution."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.kaiming_normal(layer.weight.data, a=0, mode="fan_in")
-    elif layer_name.find("Linear") != -1:
-        nn.init.kaiming_normal(layer.weight.data, a=0, mode="fan_in")
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_orthogonal(layer):
-    """Init layer weights with a (semi) orthogonal matrix."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.orthogonal(layer.weight.data, gain=1)
-    elif layer_name.find("Linear") != -1:
-        nn.init.orthogonal(layer.weight.data, gain=1)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
-
-
-def init_layer_sparse(layer):
-    """Init layer weights with a sparse matrix."""
-    layer_name = layer.__class__.__name__
-    if layer_name.find("Conv") != -1:
-        nn.init.sparse(layer.weight.data, sparsity=0.1, std=0.01)
-    elif layer_name.find("Linear") != -1:
-        nn.init.sparse(layer.weight.data, sparsity=0.1, std=0.01)
-    elif layer_name.find("BatchNorm2d") != -1:
-        nn.init.uniform(layer.weight.data, 1.0, 0.02)
-        nn.init.constant(layer.bias.data, 0.0)
+
+def _weight_tensors(layer):
+    """Get weight of conv, linear and embedding layers."""
+    return [("weight", layer.weight)]
+
+
+def _norm_tensors(layer):
+    """Get affine parameters of normalization layers."""
+    if layer.weight is None:
+        return []
+    tensors = [("norm_weight", layer.weight)]
+    if layer.bias is not None:
+        tensors.append(("zero", layer.bias))
+    return tensors
+
+
+# handlers are matched in order against the mro of layer class
+LAYER_HANDLERS = [
+    (nn.modules.conv._ConvNd, _weight_tensors),
+    (nn.Linear, _weight_tensors),
+    (nn.Bilinear, _weight_tensors),
+    (nn.Embedding, _weight_tensors),
+    (nn.modules.batchnorm._NormBase, _norm_tensors),
+    (nn.GroupNorm, _norm_tensors),
+    (nn.LayerNorm, _norm_tensors),
+]
+
+_handler_cache = {}
+
+
+def get_layer_handler(layer_cls):
+    """Get handler of layer class, which is resolved only once per class.
+
+    Args:
+        layer_cls (type): Class of layer.
+
+    Returns:
+        callable: function returning (role, tensor) pairs to be initialized,
+            or None if the class is not handled.
+    """
+    if layer_cls not in _handler_cache:
+        handler = None
+        for base, candidate in LAYER_HANDLERS:
+            if issubclass(layer_cls, base):
+                handler = candidate
+                break
+        _handler_cache[layer_cls] = handler
+    return _handler_cache[layer_cls]
+
+
+def _fans(shape):
+    """Compute fan in and fan out of weight shape."""
+    receptive_field = math.prod(shape[2:]) if len(shape) > 2 else 1
+    fan_in = shape[1] * receptive_field if len(shape) > 1 else shape[0]
+    fan_out = shape[0] * receptive_field
+    return fan_in, fan_out
+
+
+def _fill_normal(batch, shape):
+    """Fill batch with normal distribution."""
+    nn.init.normal_(batch, 0.0, 0.02)
+
+
+def _fill_uniform(batch, shape):
+    """Fill batch with uniform distribution."""
+    nn.init.uniform_(batch, 0.0, 1.0)
+
+
+def _fill_xavier_normal(batch, shape):
+    """Fill batch by xavier method with normal distribution."""
+    fan_in, fan_out = _fans(shape)
+    nn.init.normal_(batch, 0.0, math.sqrt(2.0 / (fan_in + fan_out)))
+
+
+def _fill_xavier_uniform(batch, shape):
+    """Fill batch by xavier method with uniform distribution."""
+    fan_in, fan_out = _fans(shape)
+    bound = math.sqrt(6.0 / (fan_in + fan_out))
+    nn.init.uniform_(batch, -bound, bound)
+
+
+def _fill_kaiming_normal(batch, shape):
+    """Fill batch by kaiming method with normal distribution."""
+    fan_in, _ = _fans(shape)
+    gain = nn.init.calculate_gain("leaky_relu", 0)
+    nn.init.normal_(batch, 0.0, gain / math.sqrt(fan_in))
+
+
+def _fill_kaiming_uniform(batch, shape):
+    """Fill batch by kaiming method with uniform distribution."""
+    fan_in, _ = _fans(shape)
+    bound = nn.init.calculate_gain("leaky_relu", 0) * math.sqrt(3.0 / fan_in)
+    nn.init.uniform_(batch, -bound, bound)
+
+
+def _init_orthogonal(tensor):
+    """Init tensor with a (semi) orthogonal matrix."""
+    nn.init.orthogonal_(tensor, gain=1)
+
+
+def _init_sparse(tensor):
+    """Init tensor with a sparse matrix."""
+    nn.init.sparse_(tensor.view(tensor.size(0), -1), sparsity=0.1, std=0.01)
+
+
+# element-wise i.i.d. methods could be batched over same-shaped tensors
+BATCH_FILLERS = {
+    "normal": _fill_normal,
+    "uniform": _fill_uniform,
+    "xavier_normal": _fill_xavier_normal,
+    "xavier_uniform": _fill_xavier_uniform,
+    "kaiming_normal": _fill_kaiming_normal,
+    "kaiming_uniform": _fill_kaiming_uniform,
+}
+
+TENSOR_INITS = {
+    "orthogonal": _init_orthogonal,
+    "sparse": _init_sparse,
+}
+
+
+def _fill_norm_weight(batch, shape):
+    """Fill batch of norm weights with normal distribution around 1."""
+    nn.init.normal_(batch, 1.0, 0.02)
+
+
+def _fill_zero(batch, shape):
+    """Fill batch with zeros."""
+    nn.init.zeros_(batch)
+
+
+class WeightInitializer(object):
+    """Initialize weights of network with type-dispatched handlers.
+
+    Tensors of the same role, shape, dtype and device are initialized in
+    batches, by filling one stacked tensor and copying it back with
+    foreach kernels.
+
+    Args:
+        init_type (str): Method for weight initialization.
+    """
+
+    def __init__(self, init_type="normal"):
+        """Init initializer."""
+        if init_type not in BATCH_FILLERS and init_type not in TENSOR_INITS:
+            raise NotImplementedError(
+                "not-implemented initialization method {}".format(init_type))
+        self.init_type = init_type
+        self.fillers = {
+            "weight": BATCH_FILLERS.get(init_type),
+            "norm_weight": _fill_norm_weight,
+            "zero": _fill_zero
+        }
+        self.coverage = None
+
+    def __call__(self, net):
+        """Init weights in the whole network.
+
+        Args:
+            net (torch.nn.Module): Network to be initialized.
+
+        Returns:
+            dict: coverage report with number of handled and unhandled
+                layers by class name.
+        """
+        print("initialize network by method: {}".format(self.init_type))
+        groups = defaultdict(list)
+        paddings = []
+        handled, unhandled = Counter(), Counter()
+        for layer in net.modules():
+            handler = get_layer_handler(type(layer))
+            if handler is None:
+                if len(layer._parameters) > 0:
+                    unhandled[type(layer).__name__] += 1
+                continue
+            handled[type(layer).__name__] += 1
+            if isinstance(layer, nn.Embedding) and \
+                    layer.padding_idx is not None:
+                paddings.append(layer)
+            for role, tensor in handler(layer):
+                # skip tensors not materialized yet
+                if tensor.is_meta:
+                    continue
+                key = (role, tuple(tensor.shape), tensor.dtype, tensor.device)
+                groups[key].append(tensor)
+        with torch.no_grad():
+            for (role, shape, _, _), tensors in groups.items():
+                if role == "weight" and self.fillers["weight"] is None:
+                    for tensor in tensors:
+                        TENSOR_INITS[self.init_type](tensor)
+                else:
+                    self._init_batched(tensors, shape, self.fillers[role])
+            # padding embeddings are kept zero
+            for layer in paddings:
+                if not layer.weight.is_meta:
+                    layer.weight[layer.padding_idx].fill_(0)
+        self.coverage = {
+            "handled": dict(handled),
+            "unhandled": dict(unhandled)
+        }
+        if len(unhandled) > 0:
+            print("layers not initialized: {}".format(", ".join(
+                "{} x {}".format(name, num)
+                for name, num in sorted(unhandled.items()))))
+        return self.coverage
+
+    def _init_batched(self, tensors, shape, filler):
+        """Init same-shaped tensors by filling stacked batches."""
+        numel = max(math.prod(shape), 1)
+        batch_size = max(BATCH_NUMEL // numel, 1)
+        for start in range(0, len(tensors), batch_size):
+            chunk = tensors[start:start + batch_size]
+            batch = torch.empty((len(chunk), ) + shape,
+                                dtype=chunk[0].dtype,
+                                device=chunk[0].device)
+            filler(batch, shape)
+            if hasattr(torch, "_foreach_copy_"):
+                torch._foreach_copy_(chunk, list(batch.unbind(0)))
+            else:
+                for tensor, filled in zip(chunk, batch.unbind(0)):
+                    tensor.copy_(filled)
 
 
 def init_network_weights(net, init_type="normal"):
     """Init weights in the whole network."""
-    print("initialize network by method: {}".format(init_type))
-    if init_type == "normal":
-        net.apply(init_layer_normal)
-    elif init_type == "uniform":
-        net.apply(init_layer_uniform)
-    elif init_type == "xavier_normal":
-        net.apply(init_layer_xavier_normal)
-    elif init_type == "xavier_uniform":
-        net.apply(init_layer_xavier_uniform)
-    elif init_type == "kaiming_normal":
-        net.apply(init_layer_kaiming_normal)
-    elif init_type == "kaiming_uniform":
-        net.apply(init_layer_kaiming_uniform)
-    elif init_type == "orthogonal":
-        net.apply(init_layer_orthogonal)
-    elif init_type == "sparse":
-        net.apply(init_layer_sparse)
-    else:
-        raise NotImplementedError(
-            "not-implemented initialization method {}".format(init_type))
+    return WeightInitializer(init_type)(net)
 
 
 def get_initializer(init_type="normal"):
     """Get weight initializer."""
-    return partial(init_network_weights, init_type=init_type)
+    return WeightInitializer(init_type)
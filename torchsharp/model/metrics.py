@@ -3,7 +3,6 @@
 import numbers
 
 import torch
-from torch.autograd import Variable
 
 
 class BaseMeter(object):
@@ -31,63 +30,238 @@ class BaseMeter(object):
 
 
 class MultiClassAccMeter(BaseMeter):
-    """Meter for accuracy of multi-class classification task."""
+    """Meter for accuracy of multi-class classification task.
+
+    Counts are accumulated on the device of outputs, so that adding a batch
+    never synchronizes with device until `average()` is called.
+
+    Args:
+        topk (int or sequence of int): k of top-k accuracy. If a sequence
+            is given, e.g. (1, 5), accuracies of all k are computed at once.
+    """
 
     def __init__(self, topk=1):
         """Init meter."""
         super(MultiClassAccMeter, self).__init__()
         self.topk = topk
-        self.num_correct = 0
+        self.ks = [topk] if isinstance(topk, numbers.Integral) else \
+            list(topk)
+        self.maxk = max(self.ks)
+        self.num_correct = None
+        self._k_index = {}
         self.num_total = 0
 
     def parse(self, outputs, targets):
         """Parse outputs and targets."""
         # parse outputs
-        if torch.is_tensor(outputs):
-            predicted = outputs.cpu().squeeze()
-        elif isinstance(outputs, Variable):
-            predicted = outputs.data.cpu().squeeze()
+        predicted = outputs.detach()
         if predicted.dim() == 1:
             predicted = predicted.unsqueeze(dim=1)
+        assert predicted.dim() == 2, "size of outputs must be [N x C] or [N]"
 
         # parse targets
-        if torch.is_tensor(targets):
-            expected = targets.cpu().squeeze()
-        elif isinstance(targets, Variable):
-            expected = targets.cpu().data.squeeze()
-        elif isinstance(targets, numbers.Number):
-            expected = torch.Tensor([targets])
+        if isinstance(targets, numbers.Number):
+            expected = torch.tensor([targets], device=predicted.device)
+        else:
+            expected = targets.detach().to(predicted.device,
+                                           non_blocking=True).reshape(-1)
 
         # check size
         assert predicted.size(0) == expected.size(0), \
             "outputs and targets do not match"
-        assert predicted.size(1) < self.topk, "predicted classes less than k"
-        assert predicted.dim() == 2, "size of outputs must be [N x k] or [N]"
-        assert expected.dim() == 1, "size of targets must be [N]"
+        assert predicted.size(1) >= self.maxk, "predicted classes less than k"
 
         return predicted, expected
 
     def reset(self):
         """Reset metrics."""
-        self.num_correct = 0
+        self.num_correct = None
         self.num_total = 0
 
     def add(self, outputs, targets):
         """Add metrics calculated by outputs and targets."""
         # parse
         predicted, expected = self.parse(outputs, targets)
-        # count correct predictions
-        topk_cls = predicted.topk(k=self.topk, dim=1)[1]
-        num_correct = 0
-        for k in range(self.topk):
-            num_correct += topk_cls[:, k].eq(expected).sum()
+        # count correct predictions within top-1 to top-maxk
+        topk_cls = predicted.topk(k=self.maxk, dim=1)[1]
+        correct = topk_cls.eq(expected.unsqueeze(dim=1)).sum(dim=0).cumsum(0)
+        num_correct = correct.index_select(0, self._get_k_index(
+            correct.device))
         # add to summary
-        self.num_correct += num_correct
+        if self.num_correct is None:
+            self.num_correct = num_correct
+        else:
+            self.num_correct += num_correct.to(self.num_correct.device)
         self.num_total += expected.size(0)
 
+    def _get_k_index(self, device):
+        """Get index of k - 1 on device, which is created once."""
+        if device not in self._k_index:
+            self._k_index[device] = torch.tensor(
+                [k - 1 for k in self.ks], device=device)
+        return self._k_index[device]
+
     def average(self):
-        """Get average of all metrics."""
+        """Get average of all metrics.
+
+        Returns:
+            float or list: accuracy in percentage, or list of accuracies
+                for each k if topk is a sequence.
+        """
         if self.num_total == 0:
-            return 0
+            accs = [0.] * len(self.ks)
+        else:
+            accs = [
+                100. * num_correct / self.num_total
+                for num_correct in self.num_correct.tolist()
+            ]
+        return accs[0] if isinstance(self.topk, numbers.Integral) else accs
+
+
+class ConfusionMeter(BaseMeter):
+    """Meter of confusion matrix for classification and segmentation tasks.
+
+    Confusion matrix is accumulated into a fixed-size buffer on the device
+    of outputs by one scatter per batch, without host synchronization, and
+    all metrics are derived from it lazily.
+    Predicted labels out of range are counted as misses of their targets.
+    Per-class metrics with zero denominators are NaN, and all averages are
+    taken over classes present in targets, where precision of a class never
+    predicted is regarded as 0.
+
+    Args:
+        num_classes (int): Number of classes.
+        ignore_index (int, optional): Target value to be ignored, e.g.
+            void label in segmentation masks.
+    """
+
+    def __init__(self, num_classes, ignore_index=None):
+        """Init meter."""
+        super(ConfusionMeter, self).__init__()
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.matrix = None
+        self._counts = None
+
+    def parse(self, outputs, targets):
+        """Parse outputs and targets.
+
+        Outputs could be scores of size [N x C x ...] or predicted labels
+        of the same size as targets [N x ...]. Predicted labels out of range
+        are mapped to `num_classes`, and ignored targets are mapped to -1.
+        """
+        predicted = outputs.detach()
+        expected = targets.detach().to(predicted.device, non_blocking=True)
+        if predicted.dim() == expected.dim() + 1:
+            predicted = predicted.argmax(dim=1)
+        assert predicted.size() == expected.size(), \
+            "outputs and targets do not match"
+        predicted, expected = predicted.reshape(-1), expected.reshape(-1)
+        valid = (expected >= 0) & (expected < self.num_classes)
+        if self.ignore_index is not None:
+            valid &= expected != self.ignore_index
+        predicted, expected = predicted.long(), expected.long()
+        expected = expected.masked_fill(~valid, -1)
+        predicted = predicted.masked_fill(
+            (predicted < 0) | (predicted >= self.num_classes),
+            self.num_classes)
+        return predicted, expected
+
+    def reset(self):
+        """Reset metrics."""
+        self.matrix = None
+        self._counts = None
+
+    def add(self, outputs, targets):
+        """Add outputs and targets into confusion matrix."""
+        predicted, expected = self.parse(outputs, targets)
+        # last column counts predictions out of range
+        num_columns = self.num_classes + 1
+        num_cells = self.num_classes * num_columns
+        if self._counts is None:
+            # last bin counts ignored targets
+            self._counts = torch.zeros(num_cells + 1,
+                                       dtype=torch.long,
+                                       device=predicted.device)
+            self.matrix = self._counts[:num_cells].view(
+                self.num_classes, num_columns)
+        cells = torch.where(expected >= 0, expected * num_columns + predicted,
+                            num_cells).to(self._counts.device)
+        self._counts.index_add_(0, cells, torch.ones_like(cells))
+
+    def confusion(self):
+        """Get confusion matrix with rows of targets and columns of outputs."""
+        if self.matrix is None:
+            return torch.zeros(self.num_classes, self.num_classes,
+                               dtype=torch.long)
+        return self.matrix[:, :self.num_classes]
+
+    def _stats(self):
+        """Get true positives, false positives and false negatives."""
+        if self.matrix is None:
+            matrix = torch.zeros(self.num_classes, self.num_classes + 1,
+                                 dtype=torch.double)
         else:
-            return 100. * self.num_correct / self.num_total
+            matrix = self.matrix.double()
+        tp = matrix.diagonal()
+        fp = matrix[:, :self.num_classes].sum(dim=0) - tp
+        return tp, fp, matrix.sum(dim=1) - tp
+
+    def precision(self):
+        """Get precision of each class."""
+        tp, fp, _ = self._stats()
+        return tp / (tp + fp)
+
+    def recall(self):
+        """Get recall of each class."""
+        tp, _, fn = self._stats()
+        return tp / (tp + fn)
+
+    def f1(self):
+        """Get F1 score of each class."""
+        tp, fp, fn = self._stats()
+        return 2 * tp / (2 * tp + fp + fn)
+
+    def iou(self):
+        """Get intersection over union of each class."""
+        tp, fp, fn = self._stats()
+        return tp / (tp + fp + fn)
+
+    def accuracy(self):
+        """Get overall accuracy."""
+        return self.average()["accuracy"] / 100.
+
+    def balanced_accuracy(self):
+        """Get accuracy averaged over classes, i.e. mean recall."""
+        return self.average()["balanced_accuracy"] / 100.
+
+    def mean_iou(self):
+        """Get mean intersection over union of classes."""
+        return self.average()["miou"] / 100.
+
+    def average(self):
+        """Get average of all metrics in percentage.
+
+        Returns:
+            dict: accuracy, balanced accuracy, macro precision, macro recall,
+                macro F1 and mIoU.
+        """
+        tp, fp, fn = self._stats()
+        present = (tp + fn) > 0
+        per_class = torch.stack([
+            (tp / (tp + fp)).nan_to_num(0.), tp / (tp + fn),
+            2 * tp / (2 * tp + fp + fn), tp / (tp + fp + fn)
+        ])[:, present]
+        means = per_class.mean(dim=1) if per_class.size(1) > 0 else \
+            per_class.new_zeros(4)
+        accuracy = tp.sum() / (tp.sum() + fn.sum()).clamp(min=1)
+        values = torch.cat([accuracy.view(1), means]).mul(100.).tolist()
+        precision, recall, f1, miou = values[1:]
+        return {
+            "accuracy": values[0],
+            "balanced_accuracy": recall,
+            "precision": precision,
+            "recall": recall,
+            "f1": f1,
+            "miou": miou
+        }
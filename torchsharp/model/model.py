@@ -1,9 +1,15 @@
 """High-level Model class."""
 
 import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
+from .checkpoint import (AsyncCheckpointWriter, atomic_save, get_rng_state,
+                         load_checkpoint_file, materialize_network,
+                         set_rng_state)
 from .initializer import get_initializer
 from .lr_scheduler import get_scheduler
 from .optimizer import get_optimizer
@@ -30,6 +36,11 @@ class BaseModel(object):
         self.schedulers = []
         self.initializer = None
         self.metrics = None
+        self.data_iterators = []
+        self.data_iterator_names = []
+        self.checkpoint_writer = None
+        self.restore_time = None
+        self.pending_states = {"optimizers": [], "schedulers": []}
 
     def initialize(self, cfg):
         """Init model with network and config.
@@ -41,24 +52,61 @@ class BaseModel(object):
         self.gpu_ids = cfg.gpu_ids
         self.training = cfg.training
         self.initializer = get_initializer(cfg.init_type)
+        if getattr(cfg, "async_checkpoint", False):
+            self.checkpoint_writer = AsyncCheckpointWriter()
 
     def setup_network(self, net, net_name, epoch=None, init=False):
         """To setup network and add it to model.
 
+        Network built on meta device by `deferred_init()` is materialized
+        from checkpoint directly, and only tensors not covered by
+        checkpoint are allocated and initialized. Restored network is
+        never re-initialized.
+
         Args:
             net (torch.nn.Module): Network object.
             net_name (str): Network name.
             epoch (int, optional): Epoch number to find network checkpoint.
             init (bool, optional): Whether to init weigths of network.
         """
-        if epoch is not None:
-            self.restore_network(net, net_name, epoch)
-        if init:
-            self.initializer(net)
+        if any(param.is_meta for param in net.parameters()):
+            self.materialize_network(net, net_name, epoch, init)
+        else:
+            if epoch is not None:
+                self.restore_network(net, net_name, epoch)
+            if init and not getattr(net, "restored", False):
+                self.initializer(net)
         if torch.cuda.is_available():
             net.cuda()
         self.add_network(net, net_name)
 
+    def materialize_network(self, net, net_name, epoch=None, init=False):
+        """Materialize network on meta device from checkpoint.
+
+        Args:
+            net (torch.nn.Module): Network built by `deferred_init()`.
+            net_name (str): Network name.
+            epoch (int, optional): Epoch number to find network checkpoint.
+            init (bool, optional): Whether to init weigths not covered by
+                checkpoint.
+        """
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        state_dict = None
+        if epoch is not None:
+            state_dict, _ = self.load_network_state(net_name, epoch, device)
+        if state_dict is None:
+            state_dict = {}
+        else:
+            net.restored = True
+        uncovered = materialize_network(
+            net,
+            state_dict,
+            device=device,
+            initializer=self.initializer if init else None)
+        print("materialize network {}: {} tensors from checkpoint, "
+              "{} tensors initialized".format(net_name, len(state_dict),
+                                              len(uncovered)))
+
     def setup_optimizer(self, net, optim_type=None):
         """To setup optimizer for network.
 
@@ -68,8 +116,9 @@ class BaseModel(object):
         """
         if optim_type is None:
             optim_type = self.cfg.optimizer
-        optimizer = get_optimizer(net.parameters(), optim_type)
+        optimizer = get_optimizer(net.parameters(), self.cfg, optim_type)
         self.optimizers.append(optimizer)
+        self._apply_pending_state("optimizers")
         self.setup_scheduler(optimizer)
 
     def setup_optimizers(self, optim_type=None):
@@ -91,6 +140,15 @@ class BaseModel(object):
             optimizer (torch.optim.Optimizer): Optimizer for network.
         """
         self.schedulers.append(get_scheduler(optimizer, self.cfg))
+        self._apply_pending_state("schedulers")
+
+    def _apply_pending_state(self, kind):
+        """Load restored state into the latest optimizer or scheduler."""
+        objs, states = getattr(self, kind), self.pending_states[kind]
+        idx = len(objs) - 1
+        if idx < len(states) and states[idx] is not None:
+            objs[idx].load_state_dict(states[idx])
+            states[idx] = None
 
     def add_network(self, net, net_name):
         """Add network object to model.
@@ -103,6 +161,17 @@ class BaseModel(object):
         self.network_names.append(net_name)
         setattr(self, net_name, net)
 
+    def add_data_iterator(self, iterator, name):
+        """Add data iterator whose position is saved with networks.
+
+        Args:
+            iterator (InfIterator): Data iterator with `state_dict()` and
+                `load_state_dict()`, e.g. from `get_inf_iterator`.
+            name (str): Data iterator name.
+        """
+        self.data_iterators.append(iterator)
+        self.data_iterator_names.append(name)
+
     def save_network(self, epoch, net, net_name):
         """Save network checkpoint.
 
@@ -116,7 +185,7 @@ class BaseModel(object):
         filepath = os.path.join(savedir, filename)
         if not os.path.exists(savedir):
             os.makedirs(savedir)
-        torch.save(net.state_dict(), filepath)
+        self.save_checkpoint_file(net.state_dict(), filepath)
         print("save network {} to {}".format(net_name, filepath))
 
     def save_networks(self, epoch):
@@ -127,37 +196,258 @@ class BaseModel(object):
         """
         for idx, net in enumerate(self.networks):
             self.save_network(epoch, net, self.network_names[idx])
+        self.save_data_iterators(epoch)
+
+    def save_data_iterators(self, epoch):
+        """Save positions of all data iterators in model.
+
+        Args:
+            epoch (int): Current epoch number.
+        """
+        if len(self.data_iterators) == 0:
+            return
+        savedir = os.path.join(self.cfg.model_root, self.cfg.name)
+        filepath = os.path.join(savedir, "{}-data.pt".format(epoch))
+        if not os.path.exists(savedir):
+            os.makedirs(savedir)
+        self.save_checkpoint_file({
+            name: iterator.state_dict()
+            for name, iterator in zip(self.data_iterator_names,
+                                      self.data_iterators)
+        }, filepath)
+        print("save data iterators to {}".format(filepath))
+
+    def save_checkpoint(self, epoch):
+        """Save consolidated checkpoint of the whole model.
+
+        All networks, optimizers, schedulers, data iterators, random
+        generator states and config are saved into one file with a
+        manifest. Tensors shared by networks and optimizers are
+        serialized only once.
+
+        Args:
+            epoch (int): Current epoch number.
+        """
+        savedir = os.path.join(self.cfg.model_root, self.cfg.name)
+        filepath = os.path.join(savedir, "{}-checkpoint.pt".format(epoch))
+        if not os.path.exists(savedir):
+            os.makedirs(savedir)
+        manifest = {
+            "epoch": epoch,
+            "networks": list(self.network_names),
+            "num_optimizers": len(self.optimizers),
+            "num_schedulers": len(self.schedulers),
+            "data_iterators": list(self.data_iterator_names),
+            "torch_version": str(torch.__version__)
+        }
+        checkpoint = {
+            "manifest": manifest,
+            "networks": {
+                name: net.state_dict()
+                for name, net in zip(self.network_names, self.networks)
+            },
+            "optimizers": [opt.state_dict() for opt in self.optimizers],
+            "schedulers": [sch.state_dict() for sch in self.schedulers],
+            "data_iterators": {
+                name: iterator.state_dict()
+                for name, iterator in zip(self.data_iterator_names,
+                                          self.data_iterators)
+            },
+            "rng_state": get_rng_state(),
+            "cfg": vars(self.cfg)
+        }
+        self.save_checkpoint_file(checkpoint, filepath)
+        print("save checkpoint to {}".format(filepath))
+
+    def restore_checkpoint(self, epoch=None, filepath=None):
+        """Restore consolidated checkpoint of the whole model.
+
+        Args:
+            epoch (int, optional): Epoch number to find checkpoint.
+            filepath (str, optional): Path to checkpoint.
+
+        Returns:
+            dict: manifest of checkpoint, or None if it doesn't exist.
+        """
+        if filepath is None and epoch is not None:
+            filepath = os.path.join(self.cfg.model_root, self.cfg.name,
+                                    "{}-checkpoint.pt".format(epoch))
+        if filepath is None or not os.path.exists(filepath):
+            return None
+        start = time.perf_counter()
+        checkpoint = load_checkpoint_file(
+            filepath,
+            map_location="cpu",
+            mmap=getattr(self.cfg, "mmap_checkpoint", False))
+        manifest = checkpoint["manifest"]
+        for name, net in zip(self.network_names, self.networks):
+            if name in checkpoint["networks"]:
+                net.load_state_dict(checkpoint["networks"][name])
+                net.restored = True
+        for kind in ["optimizers", "schedulers"]:
+            self._restore_states(kind, checkpoint[kind])
+        for name, iterator in zip(self.data_iterator_names,
+                                  self.data_iterators):
+            if name in checkpoint["data_iterators"]:
+                iterator.load_state_dict(checkpoint["data_iterators"][name])
+        set_rng_state(checkpoint["rng_state"])
+        self.restore_time = time.perf_counter() - start
+        print("restore checkpoint from {} in {:.3f}s".format(
+            filepath, self.restore_time))
+        return manifest
+
+    def _restore_states(self, kind, states):
+        """Restore states of optimizers or schedulers.
+
+        States of the ones not set up yet are kept pending, and loaded by
+        `setup_optimizer()` and `setup_scheduler()` later.
+        """
+        objs = getattr(self, kind)
+        if len(objs) > len(states):
+            warnings.warn("{} {} in model but {} in checkpoint, the extra "
+                          "ones start from scratch".format(
+                              len(objs), kind, len(states)))
+        for obj, state in zip(objs, states):
+            obj.load_state_dict(state)
+        pending = [None] * len(objs) + list(states[len(objs):])
+        self.pending_states[kind] = pending
+        if len(states) > len(objs):
+            warnings.warn("states of {} {} are kept until they're set "
+                          "up".format(len(states) - len(objs), kind))
+
+    def save_checkpoint_file(self, obj, filepath):
+        """Save checkpoint file atomically, in background if enabled.
 
-    def restore_network(self, net, net_name, epoch=None, filepath=None):
+        Args:
+            obj (object): Object to be saved, e.g. state_dict.
+            filepath (str): Path to checkpoint file.
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(obj, filepath)
+        else:
+            atomic_save(obj, filepath)
+
+    def wait_checkpoints(self):
+        """Wait until all checkpoints saved in background are written."""
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+    def restore_network(self,
+                        net,
+                        net_name,
+                        epoch=None,
+                        filepath=None,
+                        map_location=None):
         """Restore network checkpoint.
 
         Support automatically restore network in checkpoint folder
-        by epoch and name, or just from manual filepath.
+        by epoch and name, or just from manual filepath. Tensors are
+        loaded onto the device of network unless map_location is given,
+        and are memory-mapped if `cfg.mmap_checkpoint` is set.
 
         Args:
             net (torch.nn.Module): Network object to be saved.
             net_name (str): Network name string.
             epoch (int, optional): Epoch number to find network checkpoint.
             filepath (str, optional): Path to network checkpoint.
+            map_location (str or torch.device, optional): Device to load
+                tensors onto.
         """
-        # restore from default path
-        if filepath is None and epoch is not None:
-            filepath = os.path.join(self.cfg.model_root, self.cfg.name,
-                                    "{}-{}.pt".format(epoch, net_name))
-        # restore network
-        if filepath is not None and os.path.exists(filepath):
-            net.load_state_dict(torch.load(filepath))
+        if map_location is None:
+            param = next(net.parameters(), None)
+            map_location = "cpu" if param is None else param.device
+        state_dict, filepath = self.load_network_state(
+            net_name, epoch, map_location, filepath)
+        if state_dict is not None:
+            net.load_state_dict(state_dict)
             net.restored = True
             print("restore network {} from {}".format(net_name, filepath))
 
+    def load_network_state(self,
+                           net_name,
+                           epoch=None,
+                           map_location=None,
+                           filepath=None):
+        """Load state dict of network from checkpoint.
+
+        Network checkpoint `{epoch}-{net_name}.pt` is preferred, otherwise
+        network is loaded from consolidated checkpoint of epoch, which is
+        memory-mapped so that other networks in it are not read.
+
+        Args:
+            net_name (str): Network name string.
+            epoch (int, optional): Epoch number to find network checkpoint.
+            map_location (str or torch.device, optional): Device to load
+                tensors onto.
+            filepath (str, optional): Path to network checkpoint.
+
+        Returns:
+            tuple: state dict (or None if not found) and path of checkpoint.
+        """
+        mmap = getattr(self.cfg, "mmap_checkpoint", False)
+        savedir = os.path.join(self.cfg.model_root, self.cfg.name)
+        if filepath is None and epoch is not None:
+            filepath = os.path.join(savedir,
+                                    "{}-{}.pt".format(epoch, net_name))
+            if not os.path.exists(filepath):
+                checkpoint_path = os.path.join(
+                    savedir, "{}-checkpoint.pt".format(epoch))
+                if os.path.exists(checkpoint_path):
+                    checkpoint = load_checkpoint_file(
+                        checkpoint_path, map_location=map_location, mmap=True)
+                    return (checkpoint["networks"].get(net_name),
+                            checkpoint_path)
+        if filepath is None or not os.path.exists(filepath):
+            return None, filepath
+        return load_checkpoint_file(
+            filepath, map_location=map_location, mmap=mmap), filepath
+
     def restore_networks(self, epoch):
         """Restore all networks in model.
 
+        If consolidated checkpoint of epoch exists, optimizers, schedulers,
+        data iterators and random generators are restored together.
+
         Args:
             epoch (int): Current epoch number.
         """
-        for idx, net in enumerate(self.networks):
-            self.restore_network(net, self.network_names[idx], epoch=epoch)
+        if self.restore_checkpoint(epoch) is not None:
+            return
+        start = time.perf_counter()
+        num_workers = getattr(self.cfg, "restore_workers", 4)
+        if num_workers > 1 and len(self.networks) > 1:
+            # torch.load and copying tensors release the GIL
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [
+                    executor.submit(self.restore_network, net, name, epoch)
+                    for net, name in zip(self.networks, self.network_names)
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for idx, net in enumerate(self.networks):
+                self.restore_network(net, self.network_names[idx], epoch=epoch)
+        self.restore_data_iterators(epoch)
+        self.restore_time = time.perf_counter() - start
+        print("restore networks of epoch {} in {:.3f}s".format(
+            epoch, self.restore_time))
+
+    def restore_data_iterators(self, epoch):
+        """Restore positions of all data iterators in model.
+
+        Args:
+            epoch (int): Epoch number to find data checkpoint.
+        """
+        filepath = os.path.join(self.cfg.model_root, self.cfg.name,
+                                "{}-data.pt".format(epoch))
+        if len(self.data_iterators) == 0 or not os.path.exists(filepath):
+            return
+        states = torch.load(filepath, map_location="cpu")
+        for name, iterator in zip(self.data_iterator_names,
+                                  self.data_iterators):
+            if name in states:
+                iterator.load_state_dict(states[name])
+        print("restore data iterators from {}".format(filepath))
 
     def forward(self):
         """Forward network with input."""
@@ -3,11 +3,13 @@
 import torch
 
 
-def get_optimizer(parameters, cfg):
-    """Get optimizer."""
-    if cfg.optimizer == "adam":
+def get_optimizer(parameters, cfg, optim_type=None):
+    """Get optimizer, whose type defaults to `cfg.optimizer`."""
+    if optim_type is None:
+        optim_type = cfg.optimizer
+    if optim_type == "adam":
         return torch.optim.Adam(
             parameters, lr=cfg.lr, betas=(cfg.beta1, 0.999))
     else:
         raise NotImplementedError("not implemented optimizer {}"
-                                  .format(cfg.optimizer))
+                                  .format(optim_type))
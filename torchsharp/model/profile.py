@@ -5,6 +5,8 @@ import os
 
 import torch
 
+from ..data.stats import load_dataset_stats
+
 
 class PlainProfile(object):
     """A Plain Template for Profile.
@@ -94,17 +96,25 @@ class BaseProfile(PlainProfile):
         self.parser.add_argument(
             "--data-mean",
             type=float,
-            default=[0.485, 0.456, 0.406],
+            default=None,
             nargs=3,
             metavar=("R", "G", "B"),
-            help="mean value of images in dataset")
+            help="mean value of images in dataset "
+            "(default: from --data-stats, or ImageNet mean)")
         self.parser.add_argument(
             "--data-std",
             type=float,
-            default=[0.229, 0.224, 0.225],
+            default=None,
             nargs=3,
             metavar=("R", "G", "B"),
-            help="std value of images in dataset")
+            help="std value of images in dataset "
+            "(default: from --data-stats, or ImageNet std)")
+        self.parser.add_argument(
+            "--data-stats",
+            type=str,
+            default=None,
+            help="path to dataset statistics saved by "
+            "compute_dataset_stats")
         self.parser.add_argument(
             "--load-size",
             type=int,
@@ -146,6 +156,15 @@ class BaseProfile(PlainProfile):
             type=str,
             default=None,
             help="epoch of model checkpoint to restore")
+        self.parser.add_argument(
+            "--mmap-checkpoint",
+            action="store_true",
+            help="memory-map tensors when restoring checkpoint")
+        self.parser.add_argument(
+            "--restore-workers",
+            type=int,
+            default=4,
+            help="number of threads to restore networks concurrently")
         self.parser.add_argument(
             "--init-type",
             default="xavier_normal",
@@ -169,6 +188,19 @@ class BaseProfile(PlainProfile):
             torch.cuda.set_device(self.cfg.gpu_ids[0])
         else:
             self.cfg.gpu_ids = []
+        # fill mean and std of images which are not given
+        stats = None
+        if self.cfg.data_stats is not None:
+            stats = load_dataset_stats(self.cfg.data_stats)
+            if stats is None:
+                raise IOError("dataset stats file not exists in {}".format(
+                    self.cfg.data_stats))
+        if self.cfg.data_mean is None:
+            self.cfg.data_mean = ([0.485, 0.456, 0.406] if stats is None else
+                                  stats["mean"].tolist())
+        if self.cfg.data_std is None:
+            self.cfg.data_std = ([0.229, 0.224, 0.225] if stats is None else
+                                 stats["std"].tolist())
         return self.cfg
 
 
@@ -248,6 +280,10 @@ class TrainProfile(BaseProfile):
             type=int,
             default=50,
             help="step to save model checkpoint")
+        self.parser.add_argument(
+            "--async-checkpoint",
+            action="store_true",
+            help="save model checkpoint in background")
 
 
 class TestProfile(BaseProfile):